@@ -2,9 +2,31 @@ import os
 import yaml
 import logging
 import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from modules.utils import setup_logging, ensure_dir_exists, check_storage
-from modules.downloader import download_file
-from modules.processor import process_netcdf_file
+from modules.downloader import (
+    download_files, read_checksum_sidecar, DEFAULT_MAX_WORKERS, DEFAULT_CHUNK_SIZE, DEFAULT_SEGMENTS, DEFAULT_SEGMENT_THRESHOLD
+)
+from modules.search import (
+    plan_search_files, checksums_by_url, ESGF_SEARCH_URL, DEFAULT_PAGE_SIZE, DEFAULT_SEARCH_TTL_HOURS,
+    DEFAULT_SEARCH_WORKERS
+)
+from modules.hosts import HostScheduler
+from modules.probe import probe_urls, DEFAULT_TTL_HOURS, DEFAULT_PROBE_WORKERS
+from modules.processor import process_netcdf_file_regions, packing_without_range
+from modules.grid_index import GridIndexCache
+from modules.manifest import Manifest, STATUS_DONE, STATUS_FAILED
+from modules.metrics import metrics_recorder, timed_call, DEFAULT_SUMMARY_TOP
+from modules.ensemble import (
+    ensemble_statistics, ensemble_is_current, group_ensemble_members, DEFAULT_PERCENTILES, DEFAULT_HISTOGRAM_BINS,
+    DEFAULT_ENSEMBLE_MEMORY_MB, DEFAULT_MIN_MEMBERS
+)
+
+# default number of processing worker processes (overridable from config.yaml 'processing_settings')
+DEFAULT_PROCESS_WORKERS = 4
+
 
 def get_variable_category(variable, categories_map):
     """Finds the category for a given variable from the config map"""
@@ -14,6 +36,78 @@ def get_variable_category(variable, categories_map):
     return "uncategorized"
 
 
+def build_candidate_urls(dataset, group):
+    """
+    Expands the full discovery lists of a dataset and one of its configuration
+    groups into candidate URLs. Returns a dict mapping each URL to its variable.
+    """
+    candidates = {}
+
+    # get the global discovery lists
+    ensemble_members = dataset.get('ensemble_members', [])
+    grids_to_try = dataset.get('grids_to_try', [])
+    versions_to_try = dataset.get('versions_to_try', [])
+
+    mip_tables = group.get('mip_tables', [])
+    time_periods = group.get('time_periods', [])
+    variables = group.get('variables', [])
+
+    # --- full discovery nested loops ---
+    for variable in variables:
+        for mip_table in mip_tables:
+            for member in ensemble_members:
+                for grid in grids_to_try:
+                    for version in versions_to_try:
+                        for period in time_periods:
+                            url = dataset['url_template'].format(
+                                experiment=dataset['experiment'],
+                                ensemble_member=member,
+                                mip_table=mip_table,
+                                variable=variable,
+                                grid=grid,
+                                version=version,
+                                time_period=period
+                            )
+                            candidates[url] = variable
+    return candidates
+
+
+def build_processed_dir(base_path, region_name, dataset, category):
+    """Builds the output directory for a processed file of a given region and dataset"""
+    # building the base path for the region and model
+    base_processed_dir = os.path.join(base_path, region_name, dataset['model'])
+
+    # check the dataset type from the config
+    if dataset.get('type') == 'scenario':
+        # if it's a scenario, add the 'scenarios' subfolder
+        return os.path.join(base_processed_dir, 'scenarios', dataset['experiment'], category)
+    # otherwise use the existing structure (for historical)
+    return os.path.join(base_processed_dir, dataset['experiment'], category)
+
+
+def plan_ensemble_jobs(base_path, datasets, processing_regions, variable_map, min_members=DEFAULT_MIN_MEMBERS):
+    """
+    Lists the ensemble-summary products to (re)compute: per processed directory of
+    each dataset and region, the per-member files of one variable and period are
+    grouped, and a group is kept if it has enough members and its product is
+    missing or was computed from a different set of members.
+    Returns a list of (output_path, member_paths, variable).
+    """
+    jobs = []
+    for dataset in datasets:
+        for region in processing_regions:
+            for category in list(variable_map) + ['uncategorized']:
+                processed_dir = build_processed_dir(base_path, region['name'], dataset, category)
+                if not os.path.isdir(processed_dir):
+                    continue
+                paths = [os.path.join(processed_dir, name) for name in os.listdir(processed_dir)]
+                for output_path, member_paths in group_ensemble_members(paths).items():
+                    if len(member_paths) < min_members or ensemble_is_current(output_path, member_paths):
+                        continue
+                    jobs.append((output_path, member_paths, os.path.basename(output_path).split('_')[0]))
+    return jobs
+
+
 def main():
     """Main pipeline orchestrator."""
 
@@ -24,6 +118,11 @@ def main():
         action='append', # allows specifying the flag multiple times
         help='The specific dataset name from config.yaml to run (e.g., --name ESM4_ssp245). Can be used multiple times.'
     )
+    parser.add_argument(
+        '--rebuild-manifest',
+        action='store_true',
+        help='Rebuild the state manifest from a scan of the existing raw and processed files before running.'
+    )
     args = parser.parse_args()
     # --- end of argparse ---
 
@@ -43,10 +142,40 @@ def main():
         logging.error("No 'processing_regions' defined in config.yaml. Aborting.")
         return
         
+    # region index ranges are computed once per distinct grid and reused for every file
+    index_cache = GridIndexCache(
+        os.path.join(base_path, config.get('grid_index_cache', 'grid_index_cache.json')), processing_regions
+    )
+
     variable_map = config['variable_categories']
+    output_encoding = config.get('output_encoding', {})
+    output_backend = config.get('output_backend', 'netcdf')
+    zarr_chunks = config.get('zarr_chunks')
+    temporal_aggregation = config.get('temporal_aggregation') or {}
+    processing_settings = config.get('processing_settings', {})
+    memory_budget_mb = processing_settings.get('memory_budget_mb')
+    process_workers = processing_settings.get('workers', DEFAULT_PROCESS_WORKERS)
+    max_pending_raw_files = processing_settings.get('max_pending_raw_files', 2 * process_workers)
+    if memory_budget_mb and packing_without_range(output_encoding):
+        # streamed subsets cannot be scanned for their range without reading the raw file twice
+        logging.error(f"Packing {packing_without_range(output_encoding)} needs 'valid_min'/'valid_max' in output_encoding when processing_settings.memory_budget_mb is set. Aborting.")
+        return
     raw_download_dir = os.path.join(base_path, config['raw_data_dir'])
     ensure_dir_exists(raw_download_dir)
 
+    # --- metrics ---
+    # one structured event per downloaded and processed file (see metrics_settings)
+    metrics = metrics_recorder(config, base_path, 'pipeline')
+
+    # --- state manifest ---
+    # what is already downloaded and processed is planned from the manifest with one
+    # query per table, instead of stat calls per file and region on the datalake
+    manifest = Manifest(os.path.join(base_path, os.path.expanduser(config.get('manifest_file', 'manifest.sqlite'))))
+    if args.rebuild_manifest or manifest.is_new:
+        manifest.rebuild(raw_download_dir, base_path, processing_regions)
+    done_raw_files = manifest.done_raw_files()
+    done_outputs = manifest.done_outputs(output_backend)
+
     # --- filter datasets based on arguments ---
     datasets_to_run = []
     if args.name:
@@ -66,74 +195,209 @@ def main():
         logging.info("No specific dataset name provided. Running for all datasets in config.yaml.")
         datasets_to_run = config.get('datasets', [])
 
+    # --- download engine settings ---
+    download_settings = config.get('download_settings', {})
+    max_workers = download_settings.get('max_workers', DEFAULT_MAX_WORKERS)
+    chunk_size = int(download_settings.get('chunk_size_kb', DEFAULT_CHUNK_SIZE // 1024) * 1024)
+    segments = download_settings.get('segments', DEFAULT_SEGMENTS)
+    segment_threshold = int(download_settings.get('segment_threshold_mb', DEFAULT_SEGMENT_THRESHOLD // 1024**2) * 1024**2)
+    # per-host connection/bandwidth limits, retries and circuit breakers, shared by every batch of the run
+    hosts = HostScheduler(download_settings.get('hosts'))
+
+    # --- URL probe settings ---
+    probe_settings = config.get('probe_settings', {})
+    probe_cache_path = os.path.join(base_path, probe_settings.get('cache_file', 'probe_cache.json'))
+
+    # --- search settings ---
+    # datasets with a 'source_id' are planned from the ESGF search index, the
+    # others (e.g. SPEAR on S3) from their url_template
+    search_settings = config.get('search_settings', {})
+    search_cache_dir = os.path.join(base_path, search_settings.get('cache_dir', 'search_cache'))
+
+    # --- Pipeline ---
+    # downloads (threads) feed a pool of processing workers (processes). A raw file
+    # holds one of 'max_pending_raw_files' slots from the moment its download starts
+    # until it has been processed, so downloads pause instead of piling up raw files
+    raw_file_slots = threading.BoundedSemaphore(max_pending_raw_files)
+    # raw files submitted to the processing pool and not finished yet (queue depth)
+    processing_queue = {'pending': 0}
+    processing_queue_lock = threading.Lock()
+
+    def _on_processed(future, raw_file_path, region_jobs, labels):
+        raw_file_slots.release()
+        with processing_queue_lock:
+            processing_queue['pending'] -= 1
+            queue_depth = processing_queue['pending']
+        outputs = [(path, region_name) for path, _, region_name in region_jobs]
+        bytes_in = os.path.getsize(raw_file_path) if os.path.exists(raw_file_path) else 0
+        if future.exception() is not None:
+            logging.error(f"Processing worker failed for {raw_file_path}. Error: {future.exception()}")
+            manifest.record_outputs(raw_file_path, outputs, output_backend, STATUS_FAILED)
+            metrics.record('process', 0.0, bytes_in, status='failed', queue_depth=queue_depth,
+                           file=os.path.basename(raw_file_path), regions=len(outputs), **labels)
+            return
+        done, seconds = future.result()
+        written = set(done)
+        manifest.record_outputs(raw_file_path, [o for o in outputs if o[0] in written], output_backend, STATUS_DONE)
+        manifest.record_outputs(raw_file_path, [o for o in outputs if o[0] not in written], output_backend, STATUS_FAILED)
+        bytes_out = sum(os.path.getsize(path) for path in written if os.path.isfile(path))
+        metrics.record('process', seconds, bytes_in, bytes_out, status='done' if len(written) == len(outputs) else 'failed',
+                       queue_depth=queue_depth, file=os.path.basename(raw_file_path), regions=len(outputs), **labels)
+
+    def _submit_processing(raw_file_path, region_jobs, labels):
+        # region_jobs: (processed_file_path, geo_scope, region_name) still to be written
+        for processed_file_path, _, _ in region_jobs:
+            ensure_dir_exists(os.path.dirname(processed_file_path))
+        with processing_queue_lock:
+            processing_queue['pending'] += 1
+        future = process_pool.submit(
+            timed_call, process_netcdf_file_regions,
+            raw_file_path, [(path, geo_scope) for path, geo_scope, _ in region_jobs], index_cache,
+            output_encoding, output_backend, zarr_chunks, memory_budget_mb, False, temporal_aggregation
+        )
+        future.add_done_callback(lambda f, path=raw_file_path, jobs=region_jobs: _on_processed(f, path, jobs, labels))
+
+    # 'spawn' keeps worker processes from inheriting the download threads' locks
+    process_pool = ProcessPoolExecutor(
+        max_workers=process_workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=setup_logging,
+        initargs=(log_path,)
+    )
+
     # --- Main Loop ---
     for dataset in datasets_to_run:
         logging.info(f"\n===== Starting Dataset: {dataset['name']} =====")
-        
-        # get the global discovery lists
-        ensemble_members = dataset.get('ensemble_members', [])
-        grids_to_try = dataset.get('grids_to_try', [])
-        versions_to_try = dataset.get('versions_to_try', [])
 
         # loop through each defined configuration group (e.g., monthly, daily)
         for group in dataset.get('configuration_groups', []):
             logging.info(f"--> Searching in Group: {group['name']}")
-            
-            mip_tables = group.get('mip_tables', [])
-            time_periods = group.get('time_periods', [])
-            variables = group.get('variables', [])
-
-            # --- full discovery nested loops ---
-            for variable in variables:
-                for mip_table in mip_tables:
-                    for member in ensemble_members:
-                        for grid in grids_to_try:
-                            for version in versions_to_try:
-                                for period in time_periods:
-                                    
-                                    url = dataset['url_template'].format(
-                                        experiment=dataset['experiment'],
-                                        ensemble_member=member,
-                                        mip_table=mip_table,
-                                        variable=variable,
-                                        grid=grid,
-                                        version=version,
-                                        time_period=period
-                                    )
-                                    file_name = url.split('/')[-1]
-
-                                    # --- DOWNLOAD STAGE ---
-                                    raw_file_path = download_file(url, raw_download_dir)
-
-                                    # --- MULTI-REGION PROCESSING STAGE ---
-                                    if raw_file_path:
-                                        for region in processing_regions:
-                                            region_name = region['name']
-                                            geo_scope = region['bounding_box']
-                                            
-                                            category = get_variable_category(variable, variable_map)
-                                            '''final_processed_dir = os.path.join(
-                                                base_path, region_name, dataset['model'], 
-                                                dataset['experiment'], category
-                                            )'''
-                                            # building the base path for the region and model
-                                            base_processed_dir = os.path.join(base_path, region_name, dataset['model'])
-                                            
-                                            # check the dataset type from the config
-                                            if dataset.get('type') == 'scenario':
-                                                # if it's a scenario, add the 'scenarios' subfolder
-                                                final_processed_dir = os.path.join(base_processed_dir, 'scenarios', dataset['experiment'], category)
-                                            else:
-                                                # otherwise use the existing structure (for historical)
-                                                final_processed_dir = os.path.join(base_processed_dir, dataset['experiment'], category)
-
-
-                                            ensure_dir_exists(final_processed_dir)
-                                            
-                                            processed_file_path = os.path.join(final_processed_dir, file_name)
-                                            
-                                            process_netcdf_file(raw_file_path, processed_file_path, geo_scope)
 
+            use_search = search_settings.get('enabled', False) and 'source_id' in dataset
+            if use_search:
+                # exact file list, with published sizes and checksums
+                search_files, failed_variables = plan_search_files(
+                    dataset, group,
+                    search_settings.get('search_url', ESGF_SEARCH_URL), search_cache_dir,
+                    search_settings.get('ttl_hours', DEFAULT_SEARCH_TTL_HOURS),
+                    search_settings.get('page_size', DEFAULT_PAGE_SIZE),
+                    search_settings.get('max_workers', DEFAULT_SEARCH_WORKERS)
+                )
+                candidates = {f['url']: f['variable'] for f in search_files}
+                checksums = checksums_by_url(search_files)
+                searched = set(candidates)
+                if failed_variables and 'url_template' in dataset:
+                    # the search node could not answer for these variables: guess their URLs as before
+                    logging.warning(f"Falling back to url_template for {dataset['name']} / {group['name']}: {sorted(failed_variables)}")
+                    candidates.update(build_candidate_urls(dataset, dict(group, variables=failed_variables)))
+            else:
+                candidates = build_candidate_urls(dataset, group)
+                checksums = {}
+                searched = set()
+
+            def _labels(url):
+                return {'dataset': dataset['name'], 'group': group['name'], 'variable': candidates[url]}
+
+            def _pending_region_jobs(url):
+                # the regions of a file that the manifest does not record as processed
+                file_name = url.split('/')[-1]
+                category = get_variable_category(candidates[url], variable_map)
+                jobs = []
+                for region in processing_regions:
+                    processed_file_path = os.path.join(
+                        build_processed_dir(base_path, region['name'], dataset, category), file_name
+                    )
+                    if processed_file_path not in done_outputs:
+                        jobs.append((processed_file_path, region['bounding_box'], region['name']))
+                return jobs
+
+            # --- PLANNING STAGE ---
+            # raw files the manifest knows are complete are not downloaded again; they
+            # are only processed for the regions that are still missing
+            to_download = {}
+            for url, variable in candidates.items():
+                raw_file_path = done_raw_files.get(url.split('/')[-1])
+                if raw_file_path is None:
+                    to_download[url] = variable
+                    continue
+                region_jobs = _pending_region_jobs(url)
+                if region_jobs:
+                    raw_file_slots.acquire()
+                    _submit_processing(raw_file_path, region_jobs, _labels(url))
+                    # one job per file, even if several candidate URLs share its name
+                    done_outputs.update(path for path, _, _ in region_jobs)
+
+            # --- PROBE STAGE ---
+            # prune guaranteed 404s before downloading (search results are known to exist)
+            guessed = [url for url in to_download if url not in searched]
+            if probe_settings.get('enabled', False) and guessed:
+                existing = set(probe_urls(
+                    guessed, probe_cache_path,
+                    probe_settings.get('ttl_hours', DEFAULT_TTL_HOURS),
+                    probe_settings.get('max_workers', DEFAULT_PROBE_WORKERS), hosts
+                )) | searched
+                to_download = {u: v for u, v in to_download.items() if u in existing}
+
+            # --- DOWNLOAD STAGE ---
+            # the remaining files are handed to the download engine as one batch,
+            # and each raw file is processed as soon as its transfer finishes
+            for url, raw_file_path in download_files(
+                    to_download.keys(), raw_download_dir, max_workers, chunk_size, segments, segment_threshold,
+                    checksums=checksums, slots=raw_file_slots, skip_existing=False,
+                    metrics=metrics, labels={url: _labels(url) for url in to_download}, hosts=hosts
+            ):
+                if not raw_file_path:
+                    manifest.record_raw_file(os.path.join(raw_download_dir, url.split('/')[-1]), STATUS_FAILED, url)
+                    continue
+
+                checksum_type, checksum = read_checksum_sidecar(raw_file_path) or (None, None)
+                manifest.record_raw_file(
+                    raw_file_path, STATUS_DONE, url, os.path.getsize(raw_file_path), checksum, checksum_type
+                )
+
+                # --- MULTI-REGION PROCESSING STAGE ---
+                # the raw file is opened once by a worker and fanned out to every region
+                region_jobs = _pending_region_jobs(url)
+                if region_jobs:
+                    _submit_processing(raw_file_path, region_jobs, _labels(url))
+                else:
+                    raw_file_slots.release()
+
+    # wait for the processing of the last downloaded files
+    process_pool.shutdown(wait=True)
+    manifest.close()
+
+    # --- ENSEMBLE STATISTICS STAGE ---
+    # datasets flagged with 'ensemble_statistics' get summary products over their
+    # members, streamed block by block next to the per-member files
+    ensemble_settings = config.get('ensemble_settings', {})
+    ensemble_datasets = [d for d in datasets_to_run if d.get('ensemble_statistics', False)]
+    if ensemble_datasets:
+        ensemble_jobs = plan_ensemble_jobs(
+            base_path, ensemble_datasets, processing_regions, variable_map,
+            ensemble_settings.get('min_members', DEFAULT_MIN_MEMBERS)
+        )
+        logging.info(f"Computing {len(ensemble_jobs)} ensemble-summary products.")
+        with ProcessPoolExecutor(
+                max_workers=ensemble_settings.get('workers', process_workers),
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=setup_logging,
+                initargs=(log_path,)
+        ) as ensemble_pool:
+            futures = [
+                ensemble_pool.submit(
+                    ensemble_statistics, member_paths, output_path, variable,
+                    ensemble_settings.get('percentiles', DEFAULT_PERCENTILES),
+                    ensemble_settings.get('histogram_bins', DEFAULT_HISTOGRAM_BINS),
+                    ensemble_settings.get('memory_budget_mb', DEFAULT_ENSEMBLE_MEMORY_MB)
+                )
+                for output_path, member_paths, variable in ensemble_jobs
+            ]
+            written = sum(1 for future in as_completed(futures) if future.result())
+        logging.info(f"Wrote {written} of {len(ensemble_jobs)} ensemble-summary products.")
+
+    metrics.summary(config.get('metrics_settings', {}).get('summary_top', DEFAULT_SUMMARY_TOP))
+    metrics.close()
     logging.info("\n--- GFDL Data Pipeline Finished ---")
 
 
@@ -0,0 +1,76 @@
+import os
+import logging
+from modules.catalog import TABLE_FREQUENCIES
+
+# temporal aggregate products: (CMIP6 frequency of the product, cell_methods of the reduction)
+AGGREGATE_PRODUCTS = {
+    'day': ('day', 'time: mean'),
+    'mon': ('mon', 'time: mean'),
+    'clim': ('monC', 'time: mean within years time: mean over years')
+}
+
+
+def source_frequency(ds, raw_file_path):
+    """Frequency of a raw file: its 'frequency' attribute, else the one of its MIP table"""
+    frequency = ds.attrs.get('frequency')
+    if frequency:
+        return frequency
+    parts = os.path.basename(raw_file_path).split('_')
+    return TABLE_FREQUENCIES.get(parts[1]) if len(parts) > 1 else None
+
+
+def aggregate_output_path(processed_file_path, product):
+    """
+    Path of a temporal aggregate, written next to its subset with the product
+    appended to the MIP table so it does not collide with a downloaded table:
+    '.../tas_day_GFDL-ESM4_historical_r1i1p1f1_gr1_18500101-18691231.nc'
+    -> '.../tas_day-mon_GFDL-ESM4_historical_r1i1p1f1_gr1_18500101-18691231.nc'
+    """
+    directory, file_name = os.path.split(processed_file_path)
+    parts = file_name.split('_')
+    parts[1] = f"{parts[1]}-{product}"
+    return os.path.join(directory, '_'.join(parts))
+
+
+def temporal_aggregates(subset, products):
+    """
+    Builds the configured temporal aggregates of a regional subset with vectorized
+    resample/groupby reductions: 'day' and 'mon' are daily and monthly means,
+    'clim' is the mean annual cycle (12 monthly means) over the file's period.
+    Only time-dependent data variables are reduced; bounds and other static
+    variables are carried over. The reductions stay lazy on a dask-backed subset.
+    Returns {product: dataset}.
+    """
+    if 'time' not in subset.dims:
+        return {}
+
+    names = [name for name, var in subset.data_vars.items() if 'time' in var.dims and 'bnds' not in var.dims]
+    static = subset.drop_dims('time')
+    data = subset[names]
+
+    aggregates = {}
+    for product in products:
+        if product not in AGGREGATE_PRODUCTS:
+            logging.warning(f"Unknown temporal aggregate '{product}', skipping.")
+            continue
+        frequency, cell_method = AGGREGATE_PRODUCTS[product]
+        if product == 'day':
+            reduced = data.resample(time='1D').mean(keep_attrs=True)
+        elif product == 'mon':
+            reduced = data.resample(time='MS').mean(keep_attrs=True)
+        else:
+            reduced = data.groupby('time.month').mean('time', keep_attrs=True)
+
+        aggregate = reduced.merge(static)
+        aggregate.attrs = dict(subset.attrs)
+        aggregate.attrs['frequency'] = frequency
+        for name in names:
+            aggregate[name].attrs = dict(subset[name].attrs)
+            methods = subset[name].attrs.get('cell_methods', '')
+            aggregate[name].attrs['cell_methods'] = f"{methods} {cell_method}".strip()
+            # keep the source fill markers (e.g. CMIP6 1e20) in the written product
+            aggregate[name].encoding = {
+                key: value for key, value in subset[name].encoding.items() if key in ('_FillValue', 'missing_value')
+            }
+        aggregates[product] = aggregate
+    return aggregates
@@ -0,0 +1,235 @@
+import os
+import json
+import sqlite3
+import logging
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# default number of processes reading NetCDF headers
+DEFAULT_CATALOG_WORKERS = 8
+
+# fields of a CMIP6 file name: {variable}_{table}_{source}_{experiment}_{member}_{grid}_{period}.nc
+FILENAME_FIELDS = ('variable', 'table_id', 'source_id', 'experiment_id', 'member', 'grid', 'period')
+
+# frequency of the MIP tables used in the mirror, for files without a 'frequency' attribute
+TABLE_FREQUENCIES = {'Amon': 'mon', 'Lmon': 'mon', 'Emon': 'mon', 'Omon': 'mon', 'day': 'day', 'Eday': 'day', '3hr': '3hr', '1hr': '1hr'}
+
+_INDEX_SCHEMA = """
+CREATE TABLE files (
+    path TEXT PRIMARY KEY,
+    region TEXT, model TEXT, experiment TEXT, variable TEXT, member TEXT,
+    frequency TEXT, table_id TEXT, product TEXT, grid TEXT, time_start TEXT, time_end TEXT
+);
+CREATE INDEX files_lookup ON files (region, model, experiment, variable, frequency, member);
+"""
+
+
+def _plain(value):
+    """Converts NetCDF attribute values (numpy scalars/arrays) into JSON-serialisable values"""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        # NaN fill values are not valid JSON
+        return None
+    if isinstance(value, bytes):
+        return value.decode(errors='replace')
+    return value
+
+
+def parse_processed_path(path, base_path):
+    """
+    Splits a processed file path into its catalog fields:
+    {region}/{model}/[scenarios/]{experiment}/{category}/{CMIP6 file name}.
+    Fields that cannot be recovered are left out.
+    """
+    parts = os.path.relpath(path, base_path).split(os.sep)
+    fields = {}
+    if len(parts) >= 5:
+        fields['region'], fields['model'] = parts[0], parts[1]
+        experiment_parts = parts[3:-1] if parts[2] == 'scenarios' else parts[2:-1]
+        if len(experiment_parts) == 2:
+            fields['experiment'], fields['category'] = experiment_parts
+
+    name_parts = os.path.basename(path)[:-len('.nc')].split('_')
+    if len(name_parts) == len(FILENAME_FIELDS):
+        fields.update(zip(FILENAME_FIELDS, name_parts))
+    return fields
+
+
+def read_netcdf_header(path):
+    """
+    Reads the metadata of a NetCDF file without decoding its data: dimensions,
+    variables with their attributes, global attributes, lat/lon extents and the
+    time range. Only the first and last value of each 1D coordinate is read.
+    """
+    # netCDF4 is a hard dependency of xarray's NetCDF engine, imported here so
+    # the worker processes only pay for it when they read headers
+    import netCDF4
+    import cftime
+
+    header = {'dims': {}, 'variables': {}, 'extents': {}, 'global_attrs': {}}
+    with netCDF4.Dataset(path, 'r') as nc:
+        nc.set_auto_maskandscale(False)
+        header['dims'] = {name: len(dim) for name, dim in nc.dimensions.items()}
+        header['global_attrs'] = {key: _plain(nc.getncattr(key)) for key in nc.ncattrs()}
+
+        for name, var in nc.variables.items():
+            header['variables'][name] = {
+                'dims': list(var.dimensions),
+                'dtype': str(var.dtype),
+                'attrs': {key: _plain(var.getncattr(key)) for key in var.ncattrs()}
+            }
+            # 1D coordinate variables: first and last value give the extent of a monotonic axis
+            if var.dimensions == (name,) and len(var) and name != 'time':
+                first, last = _plain(var[0]), _plain(var[-1])
+                header['extents'][name] = [min(first, last), max(first, last)]
+
+        time_var = nc.variables.get('time')
+        if time_var is not None and time_var.dimensions == ('time',) and len(time_var):
+            header['time_steps'] = len(time_var)
+            units = getattr(time_var, 'units', None)
+            calendar = getattr(time_var, 'calendar', 'standard')
+            if units:
+                first, last = cftime.num2date([time_var[0], time_var[-1]], units, calendar)
+                header['time_start'], header['time_end'] = first.isoformat(), last.isoformat()
+    return header
+
+
+def _catalog_record(args):
+    """Worker: builds the catalog record of one file from its header"""
+    path, size, mtime_ns, base_path = args
+    record = {'path': path, 'size': size, 'mtime_ns': mtime_ns}
+    record.update(parse_processed_path(path, base_path))
+    try:
+        record.update(read_netcdf_header(path))
+    except Exception as e:
+        logging.error(f"Could not read header of {path}. Reason: {e}")
+        record['error'] = str(e)
+    return record
+
+
+def load_catalog(catalog_path):
+    """Loads a JSON-lines catalog into {path: record}, or an empty catalog if there is none"""
+    records = {}
+    if not os.path.exists(catalog_path):
+        return records
+    with open(catalog_path, 'r') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                records[record['path']] = record
+    return records
+
+
+def save_catalog(records, catalog_path):
+    """Writes the catalog as JSON lines sorted by path, atomically"""
+    catalog_dir = os.path.dirname(catalog_path)
+    if catalog_dir:
+        os.makedirs(catalog_dir, exist_ok=True)
+    tmp_path = catalog_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for path in sorted(records):
+            f.write(json.dumps(records[path]) + '\n')
+    os.replace(tmp_path, catalog_path)
+
+
+def split_table_id(table_id):
+    """
+    Splits the table field of a file name into (MIP table, temporal aggregate product),
+    e.g. 'day-mon' -> ('day', 'mon') (see modules/aggregation.py), 'Amon' -> ('Amon', None)
+    """
+    if not table_id:
+        return table_id, None
+    table, _, product = table_id.partition('-')
+    return table, product or None
+
+
+def save_catalog_index(records, index_path):
+    """
+    Writes the query index next to the catalog: a small SQLite table with only the
+    fields files are looked up by (see modules/query.py), rebuilt atomically from
+    the catalog records. Temporal aggregates are indexed with their native MIP
+    table and their 'product', so they are never mistaken for native files.
+    """
+    tmp_path = index_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    rows = []
+    for record in records.values():
+        if 'error' in record:
+            continue
+        table_id, product = split_table_id(record.get('table_id'))
+        rows.append((
+            record['path'], record.get('region'), record.get('model'), record.get('experiment'),
+            record.get('variable'), record.get('member'),
+            record.get('global_attrs', {}).get('frequency') or TABLE_FREQUENCIES.get(table_id),
+            table_id, product, record.get('grid'), record.get('time_start'), record.get('time_end')
+        ))
+    conn = sqlite3.connect(tmp_path)
+    with conn:
+        conn.executescript(_INDEX_SCHEMA)
+        conn.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    conn.close()
+    os.replace(tmp_path, index_path)
+
+
+def catalog_index_path(catalog_path):
+    """Path of the query index that belongs to a catalog ('catalog.jsonl' -> 'catalog.sqlite')"""
+    return os.path.splitext(catalog_path)[0] + '.sqlite'
+
+
+def _scan_tree(root_dir):
+    """Lists (path, size, mtime_ns) of every NetCDF file below a directory"""
+    found = []
+    for root, dirs, files in os.walk(root_dir):
+        # zarr stores are directories of chunks, not part of the NetCDF catalog
+        dirs[:] = [d for d in dirs if not d.endswith('.zarr')]
+        for name in files:
+            if name.endswith('.nc'):
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                found.append((path, st.st_size, st.st_mtime_ns))
+    return found
+
+
+def build_catalog(base_path, region_names, catalog_path, max_workers=DEFAULT_CATALOG_WORKERS, rescan=False):
+    """
+    Scans every processed region tree and updates the catalog at 'catalog_path'.
+
+    Region trees are walked in parallel threads and the headers of new or changed
+    files (by size and mtime) are read in a process pool; unchanged files keep
+    their existing record and files that disappeared are dropped. With 'rescan'
+    every header is read again. The query index (see save_catalog_index) is
+    rewritten with the catalog. Returns the records as {path: record}.
+    """
+    catalog = {} if rescan else load_catalog(catalog_path)
+
+    region_dirs = [os.path.join(base_path, name) for name in region_names]
+    with ThreadPoolExecutor(max_workers=max(1, len(region_dirs))) as executor:
+        found = [entry for entries in executor.map(_scan_tree, region_dirs) for entry in entries]
+
+    records, to_read = {}, []
+    for path, size, mtime_ns in found:
+        record = catalog.get(path)
+        if record and record['size'] == size and record['mtime_ns'] == mtime_ns and 'error' not in record:
+            records[path] = record
+        else:
+            to_read.append((path, size, mtime_ns, base_path))
+    removed = len(set(catalog) - {path for path, _, _ in found})
+    logging.info(f"Catalog scan found {len(found)} files: {len(to_read)} new or changed, {removed} removed.")
+
+    if to_read:
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            for record in executor.map(_catalog_record, to_read, chunksize=16):
+                records[record['path']] = record
+
+    save_catalog(records, catalog_path)
+    save_catalog_index(records, catalog_index_path(catalog_path))
+    logging.info(f"Catalog with {len(records)} files written to: {catalog_path}")
+    return records
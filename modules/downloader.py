@@ -1,7 +1,15 @@
 import os
+import json
+import hashlib
 import requests
 import logging
+import time
+import threading
 import urllib3
+from itertools import zip_longest
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from modules.hosts import HostScheduler, IncompleteDownloadError
 
 
 # --- NEW: suppress insecure request warnings ---
@@ -9,35 +17,391 @@ import urllib3
 # single file. This line disables those specific warnings to keep our logs clean
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# --- default transfer settings (overridable from config.yaml 'download_settings') ---
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_CHUNK_SIZE = 1024 * 1024  # 1 MB reads instead of the old 8 KB
+DEFAULT_SEGMENTS = 1  # 1 = single stream; >1 splits large files into parallel ranged requests
+DEFAULT_SEGMENT_THRESHOLD = 512 * 1024 * 1024  # only split files larger than this
+DEFAULT_CHECKSUM_TYPE = 'sha256'  # used when the search index does not publish a checksum
+CHECKSUM_SIDECAR_TYPES = ('sha256', 'md5')  # checksum types ESGF publishes
 
-def download_file(url, target_dir):
+# in-progress downloads are written next to the final file with these suffixes.
+# the final name only ever appears through an atomic rename of a complete file
+PART_SUFFIX = '.part'
+SEGMENT_STATE_SUFFIX = '.segments'
+SOURCE_SUFFIX = '.source'  # URL the .part file was started from
+
+# each worker thread keeps its own session so keep-alive connections are reused
+# per host without sharing a connection pool between threads
+_thread_local = threading.local()
+
+# per-host limits, retries and circuit breakers used when the caller brings no scheduler
+_default_hosts = HostScheduler()
+
+
+def get_session(pool_size=DEFAULT_MAX_WORKERS):
+    """Returns a per-thread requests session that reuses keep-alive connections per host"""
+    session = getattr(_thread_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        # 'verify=False' lets us download even if the SSL certificate verification fails
+        session.verify = False
+        # byte offsets only line up with the file on disk if the body is not re-encoded
+        session.headers['Accept-Encoding'] = 'identity'
+        _thread_local.session = session
+    return session
+
+
+def _parse_content_range_total(content_range):
+    """Extracts the total size from a 'bytes start-end/total' header, or None if unknown"""
+    if not content_range or '/' not in content_range:
+        return None
+    total = content_range.rsplit('/', 1)[1].strip()
+    return int(total) if total.isdigit() else None
+
+
+def _remote_file_info(session, url, host):
+    """Returns (size, accepts_ranges) for a URL using a HEAD request"""
+    with host.connection():
+        r = session.head(url, timeout=host.timeout, allow_redirects=True)
+    r.raise_for_status()
+    size = r.headers.get('Content-Length')
+    accepts_ranges = r.headers.get('Accept-Ranges', '').lower() == 'bytes'
+    return (int(size) if size else None), accepts_ranges
+
+
+def _hash_file(path, checksum_type, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Returns a hashlib object fed with the full contents of a local file"""
+    hasher = hashlib.new(checksum_type)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher
+
+
+def _stream_to_part(session, url, part_path, chunk_size, host, checksum_type=DEFAULT_CHECKSUM_TYPE):
+    """
+    Streams a URL into a .part file, resuming from its current size with a Range request.
+    The bytes are hashed as they are written, so no second read is needed to checksum the file.
+    The transfer holds one of the host's connection slots and respects its bandwidth limit.
+    Returns (total, hasher) where total is the expected size of the file, or None if the
+    server did not report it.
+    """
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+    with host.connection(), session.get(url, stream=True, timeout=host.timeout, headers=headers) as r:
+        if offset and r.status_code == 416:
+            # the requested range starts at the end of the file: the part file is already complete
+            return _parse_content_range_total(r.headers.get('Content-Range')), _hash_file(part_path, checksum_type, chunk_size)
+        r.raise_for_status()
+
+        if r.status_code == 206:
+            logging.info(f"Resuming download from byte {offset}: {url}")
+            mode = 'ab'
+            total = _parse_content_range_total(r.headers.get('Content-Range'))
+            # the digest has to cover the bytes we already have before the new ones
+            hasher = _hash_file(part_path, checksum_type, chunk_size)
+        else:
+            # the server ignored (or was not sent) a Range header, so start from scratch
+            mode = 'wb'
+            content_length = r.headers.get('Content-Length')
+            total = int(content_length) if content_length else None
+            hasher = hashlib.new(checksum_type)
+
+        with open(part_path, mode) as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+                hasher.update(chunk)
+                host.throttle(len(chunk))
+    return total, hasher
+
+
+def _download_segments(url, part_path, total, segments, chunk_size, host):
+    """
+    Downloads a file as parallel ranged segments written in place into a
+    preallocated .part file. Per-segment progress is kept in a sidecar state
+    file so an interrupted segmented download resumes where each segment stopped.
+    Every segment holds one of the host's connection slots, so segments never
+    exceed the host's connection limit. Raises IncompleteDownloadError if a
+    segment ended early.
+    """
+    state_path = part_path + SEGMENT_STATE_SUFFIX
+    state = None
+    if os.path.exists(state_path) and os.path.exists(part_path):
+        with open(state_path, 'r') as f:
+            saved = json.load(f)
+        if saved.get('total') == total:
+            state = saved['segments']
+
+    if state is None:
+        # fresh start: split [0, total) into equal [start, end, bytes_done] ranges
+        segment_size = -(-total // segments)
+        state = [[start, min(start + segment_size, total) - 1, 0] for start in range(0, total, segment_size)]
+        with open(part_path, 'wb') as f:
+            f.truncate(total)
+
+    def _save_state():
+        with open(state_path + '.tmp', 'w') as f:
+            json.dump({'total': total, 'segments': state}, f)
+        os.replace(state_path + '.tmp', state_path)
+
+    def _segment_worker(segment):
+        start, end, done = segment
+        if start + done > end:
+            return
+        with host.connection(), get_session().get(url, stream=True, timeout=host.timeout, headers={'Range': f'bytes={start + done}-{end}'}) as r:
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise requests.RequestException(f"Server ignored Range request for segment {start}-{end}")
+            with open(part_path, 'r+b') as f:
+                f.seek(start + done)
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    segment[2] += len(chunk)
+                    host.throttle(len(chunk))
+
+    _save_state()
+    try:
+        with ThreadPoolExecutor(max_workers=segments) as executor:
+            for future in as_completed([executor.submit(_segment_worker, segment) for segment in state]):
+                future.result()
+    finally:
+        _save_state()
+
+    if not all(start + done > end for start, end, done in state):
+        raise IncompleteDownloadError(f"Segmented download incomplete for {url}")
+    os.remove(state_path)
+
+
+def _claim_part(part_path, url):
+    """
+    Makes sure a .part file is only ever resumed from the URL that started it:
+    a part left by another URL for the same file name (e.g. another version)
+    holds different bytes, so it is discarded instead of being appended to.
+    """
+    source_path = part_path + SOURCE_SUFFIX
+    if os.path.exists(source_path):
+        with open(source_path, 'r') as f:
+            source = f.read().strip()
+        if source != url:
+            logging.info(f"Discarding partial download from another source ({source}): {part_path}")
+            for path in (part_path, part_path + SEGMENT_STATE_SUFFIX):
+                if os.path.exists(path):
+                    os.remove(path)
+    with open(source_path, 'w') as f:
+        f.write(url + '\n')
+
+
+def _release_part(part_path):
+    """Removes the source record of a .part file that was renamed or discarded"""
+    if os.path.exists(part_path + SOURCE_SUFFIX):
+        os.remove(part_path + SOURCE_SUFFIX)
+
+
+def checksum_sidecar_path(file_path, checksum_type=DEFAULT_CHECKSUM_TYPE):
+    """Returns the path of the checksum file recorded next to a downloaded file"""
+    return f"{file_path}.{checksum_type.lower()}"
+
+
+def write_checksum_sidecar(file_path, digest, checksum_type=DEFAULT_CHECKSUM_TYPE):
+    """Records a file's digest next to it, in the same format as sha256sum/md5sum"""
+    # drop a stale digest of another type left over from an earlier copy of the file
+    for other_type in CHECKSUM_SIDECAR_TYPES:
+        stale = checksum_sidecar_path(file_path, other_type)
+        if other_type != checksum_type.lower() and os.path.exists(stale):
+            os.remove(stale)
+    with open(checksum_sidecar_path(file_path, checksum_type), 'w') as f:
+        f.write(f"{digest}  {os.path.basename(file_path)}\n")
+
+
+def read_checksum_sidecar(file_path):
+    """
+    Returns (checksum_type, digest) recorded next to a file at download time,
+    or None if no checksum was recorded.
+    """
+    for checksum_type in CHECKSUM_SIDECAR_TYPES:
+        sidecar = checksum_sidecar_path(file_path, checksum_type)
+        if os.path.exists(sidecar):
+            with open(sidecar, 'r') as f:
+                return checksum_type, f.read().split()[0]
+    return None
+
+
+def download_file(url, target_dir, session=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                  segments=DEFAULT_SEGMENTS, segment_threshold=DEFAULT_SEGMENT_THRESHOLD,
+                  expected_checksum=None, checksum_type=DEFAULT_CHECKSUM_TYPE, skip_existing=True, hosts=None):
     """
     Downloads a single file from a URL into a target directory.
-    Skips the download if the file already exists.
+    Skips the download if the file already exists, unless 'skip_existing' is False.
+    The transfer is written to a resumable '.part' file, checked against
+    'expected_checksum' and retried under the host's policy ('hosts', see modules/hosts.py).
 
     Now includes SSL verification disabling for certain academic servers.
     """
     local_filename = os.path.join(target_dir, url.split('/')[-1])
+    part_filename = local_filename + PART_SUFFIX
+    checksum_type = checksum_type.lower()
 
-    if os.path.exists(local_filename):
+    if skip_existing and os.path.exists(local_filename):
         logging.info(f"File already exists, skipping: {local_filename}")
         return local_filename
 
     logging.info(f"Downloading: {url}")
-    
+
+    if session is None:
+        session = get_session()
+    if hosts is None:
+        hosts = _default_hosts
+
+    def _transfer(host):
+        total = None
+        use_segments = False
+        # a leftover single-stream .part is always resumed as a single stream
+        if segments > 1 and (os.path.exists(part_filename + SEGMENT_STATE_SUFFIX) or not os.path.exists(part_filename)):
+            total, accepts_ranges = _remote_file_info(session, url, host)
+            use_segments = accepts_ranges and total is not None and total >= segment_threshold
+
+        if use_segments:
+            logging.info(f"Downloading in {segments} parallel segments ({total / 1024**2:.0f} MB): {url}")
+            _download_segments(url, part_filename, total, segments, chunk_size, host)
+            # segments arrive out of order, so the digest is computed once they are all on disk
+            hasher = _hash_file(part_filename, checksum_type, chunk_size)
+        else:
+            total, hasher = _stream_to_part(session, url, part_filename, chunk_size, host, checksum_type)
+
+        part_size = os.path.getsize(part_filename)
+        if total is not None and part_size != total:
+            raise IncompleteDownloadError(f"Incomplete download for {url}: got {part_size} of {total} bytes")
+        return hasher
+
     try:
-        # 'verify=False' argument tells requests to proceed with the
-        # download even if the SSL certificate verification fails
-        with requests.get(url, stream=True, timeout=60, verify=False) as r:
-            r.raise_for_status()
-            with open(local_filename, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
+        _claim_part(part_filename, url)
+        hasher = hosts.request(url, _transfer)
+        digest = hasher.hexdigest()
+        if expected_checksum and digest.lower() != expected_checksum.lower():
+            # a complete but corrupt file cannot be resumed, so it is discarded
+            logging.error(f"Checksum MISMATCH for {url}: expected {expected_checksum}, got {digest} ({checksum_type}). Discarding file.")
+            os.remove(part_filename)
+            _release_part(part_filename)
+            return None
+
+        # atomic rename: the final name never refers to a truncated file
+        os.replace(part_filename, local_filename)
+        _release_part(part_filename)
+        write_checksum_sidecar(local_filename, digest, checksum_type)
+        if expected_checksum:
+            logging.info(f"Checksum verified ({checksum_type}): {local_filename}")
         logging.info(f"Successfully downloaded to: {local_filename}")
         return local_filename
     except requests.RequestException as e:
+        # the partial file is kept on purpose so the next run resumes instead of starting over
         logging.error(f"Failed to download {url}. Reason: {e}")
-        # cleaning up partially downloaded file
-        if os.path.exists(local_filename):
-            os.remove(local_filename)
-        return None
\ No newline at end of file
+        return None
+
+
+def download_files(urls, target_dir, max_workers=DEFAULT_MAX_WORKERS, chunk_size=DEFAULT_CHUNK_SIZE,
+                   segments=DEFAULT_SEGMENTS, segment_threshold=DEFAULT_SEGMENT_THRESHOLD, checksums=None,
+                   slots=None, skip_existing=True, metrics=None, labels=None, hosts=None):
+    """
+    Downloads a batch of URLs concurrently using a thread pool.
+    Yields (url, local_path) tuples as each transfer finishes; local_path is None on failure.
+
+    'checksums' optionally maps a URL to its published (checksum, checksum_type).
+    'skip_existing' is passed on to download_file().
+
+    'slots' is an optional semaphore bounding how many downloaded files may be
+    waiting for the next stage. A worker takes a slot before it starts a file and
+    only gives it back itself if the download fails; for a successful file the
+    caller releases the slot once it is done with it (backpressure).
+
+    URLs that resolve to the same local filename (e.g. the same file under two
+    candidate versions) are tried one after another by a single worker, in the
+    order given, so two threads never write to the same file.
+
+    'hosts' is the HostScheduler passed on to download_file(). Files are queued
+    round-robin across hosts, so the workers are shared between the hosts
+    instead of all waiting on the connection limit of the first one listed.
+
+    With a MetricsRecorder ('metrics', see modules/metrics.py) one 'download'
+    event is recorded per file: wall time, bytes transferred in this run, the
+    retries (transient errors retried plus candidate URLs that failed before
+    it), and how many files were still queued.
+    'labels' optionally maps a URL to its dataset/group/variable labels.
+    """
+    checksums = checksums or {}
+    labels = labels or {}
+    hosts = hosts or _default_hosts
+    alternatives = {}
+    for url in urls:
+        alternatives.setdefault(url.split('/')[-1], []).append(url)
+
+    # interleave the files of the different hosts: a, b, c, a, b, c, a, a, ...
+    by_host = {}
+    for group in alternatives.values():
+        by_host.setdefault(hosts.host(group[0]).host, []).append(group)
+    groups = [group for round_ in zip_longest(*by_host.values()) for group in round_ if group is not None]
+    queued = [len(groups)]
+    queued_lock = threading.Lock()
+
+    def _record(url, local_path, part_path, started, resumed_bytes, attempts, existed=False):
+        with queued_lock:
+            queued[0] -= 1
+            queue_depth = queued[0]
+        if metrics is None:
+            return
+        size = os.path.getsize(local_path) if local_path else (os.path.getsize(part_path) if os.path.exists(part_path) else 0)
+        if existed:
+            status, bytes_in, bytes_out = 'skipped', 0, 0
+        else:
+            status, bytes_in, bytes_out = ('done' if local_path else 'failed'), max(0, size - resumed_bytes), (size if local_path else 0)
+        metrics.record(
+            'download', time.perf_counter() - started, bytes_in=bytes_in, bytes_out=bytes_out,
+            status=status, retries=attempts - 1 + hosts.take_retries(), queue_depth=queue_depth,
+            file=os.path.basename(part_path[:-len(PART_SUFFIX)]), url=url, **labels.get(url, {})
+        )
+
+    def _worker(candidate_urls):
+        if slots is not None:
+            slots.acquire()
+        started = time.perf_counter()
+        hosts.take_retries()
+        part_path = os.path.join(target_dir, candidate_urls[0].split('/')[-1]) + PART_SUFFIX
+        resumed_bytes = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        existed = skip_existing and os.path.exists(part_path[:-len(PART_SUFFIX)])
+        attempts = 0
+        try:
+            session = get_session(max_workers)
+            for url in candidate_urls:
+                attempts += 1
+                expected_checksum, checksum_type = checksums.get(url, (None, DEFAULT_CHECKSUM_TYPE))
+                local_path = download_file(
+                    url, target_dir, session, chunk_size, segments, segment_threshold,
+                    expected_checksum, checksum_type, skip_existing, hosts
+                )
+                if local_path:
+                    _record(url, local_path, part_path, started, resumed_bytes, attempts, existed)
+                    # the slot stays taken until the caller has consumed the file
+                    return url, local_path
+        except Exception:
+            _record(candidate_urls[0], None, part_path, started, resumed_bytes, max(attempts, 1))
+            if slots is not None:
+                slots.release()
+            raise
+        _record(candidate_urls[0], None, part_path, started, resumed_bytes, max(attempts, 1))
+        if slots is not None:
+            slots.release()
+        return candidate_urls[0], None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_worker, group): group for group in groups}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                url = futures[future][0]
+                logging.error(f"Unexpected error while downloading {url}. Error: {e}")
+                yield url, None
@@ -0,0 +1,210 @@
+import os
+import logging
+import numpy as np
+import xarray as xr
+
+# --- default ensemble settings (overridable from config.yaml 'ensemble_settings') ---
+DEFAULT_PERCENTILES = [10, 50, 90]
+DEFAULT_HISTOGRAM_BINS = 100       # per-cell bins for the approximate percentiles
+DEFAULT_ENSEMBLE_MEMORY_MB = 512   # memory for the accumulators of one time block
+DEFAULT_MIN_MEMBERS = 2
+
+# takes the place of the member id in the file name of ensemble-summary products
+ENSEMBLE_LABEL = 'ensemble'
+
+
+def ensemble_output_path(member_file_path):
+    """
+    Path of the ensemble-summary product of a per-member file, written next to it:
+    '.../tas_day_GFDL-SPEAR-MED_historical_r1i1p1f1_gr3_19210101-19301231.nc'
+    -> '.../tas_day_GFDL-SPEAR-MED_historical_ensemble_gr3_19210101-19301231.nc'
+    """
+    directory, file_name = os.path.split(member_file_path)
+    parts = file_name.split('_')
+    parts[4] = ENSEMBLE_LABEL
+    return os.path.join(directory, '_'.join(parts))
+
+
+def group_ensemble_members(file_paths):
+    """Groups per-member processed files into {ensemble output path: [member file paths]}"""
+    groups = {}
+    for path in sorted(file_paths):
+        parts = os.path.basename(path).split('_')
+        if len(parts) != 7 or parts[4] == ENSEMBLE_LABEL or not path.endswith('.nc'):
+            continue
+        groups.setdefault(ensemble_output_path(path), []).append(path)
+    return groups
+
+
+def _block_size(n_cells, bins, memory_budget_mb):
+    """
+    Time steps per block: the int32 histogram plus about 24 float64-sized arrays
+    per cell (member block, accumulators, statistics and their temporaries)
+    """
+    step_bytes = max(n_cells, 1) * (24 * 8 + 4 * bins)
+    return max(1, int(memory_budget_mb * 1024**2 // step_bytes))
+
+
+def _block_statistics(member_blocks, percentiles, bins):
+    """
+    Reduces one time block over the members with mergeable, streaming algorithms.
+    'member_blocks' is a callable yielding each member's block (float64 array);
+    it is iterated twice: Welford's online mean/variance plus min/max, then
+    per-cell histograms over [min, max] from which percentiles are interpolated.
+    Memory does not depend on the number of members.
+    """
+    count = mean = m2 = vmin = vmax = None
+    for values in member_blocks():
+        if count is None:
+            count = np.zeros(values.shape, dtype='int32')
+            mean = np.zeros(values.shape)
+            m2 = np.zeros(values.shape)
+            vmin = np.full(values.shape, np.nan)
+            vmax = np.full(values.shape, np.nan)
+        valid = ~np.isnan(values)
+        count += valid
+        delta = np.where(valid, values - mean, 0.0)
+        mean += np.where(valid, delta / np.maximum(count, 1), 0.0)
+        m2 += np.where(valid, delta * (np.where(valid, values, 0.0) - mean), 0.0)
+        vmin = np.fmin(vmin, values)
+        vmax = np.fmax(vmax, values)
+
+    stats = {
+        'mean': np.where(count > 0, mean, np.nan),
+        'std': np.where(count > 1, np.sqrt(m2 / np.maximum(count - 1, 1)), np.nan),
+        'min': vmin,
+        'max': vmax
+    }
+    if not percentiles:
+        return stats, count
+
+    # --- approximate percentiles from mergeable per-cell histograms ---
+    width = np.where(vmax > vmin, vmax - vmin, 1.0)
+    hist = np.zeros((bins,) + count.shape, dtype='int32')
+    flat_hist = hist.reshape(bins, -1)
+    cells = np.arange(count.size)
+    for values in member_blocks():
+        valid = ~np.isnan(values)
+        scaled = np.where(valid, (values - vmin) / width * bins, 0.0)
+        index = np.clip(scaled.astype('int64'), 0, bins - 1)
+        # every member adds at most one value per cell, so there are no repeated index pairs
+        flat_hist[index.ravel(), cells] += valid.ravel()
+    del cells, scaled, index, valid
+
+    # cumulative counts in place: member counts fit in int32, and no second histogram is allocated
+    cumulative = np.cumsum(hist, axis=0, out=hist)
+    lower = vmin
+    step = width / bins
+
+    def order_statistic(rank):
+        # value of the 0-based rank-th member, spread evenly within its histogram bin
+        target = rank + 0.5
+        # first bin reaching the target, counted bin by bin to avoid a histogram-sized comparison
+        k = np.zeros(count.shape, dtype='int64')
+        for b in range(bins - 1):
+            k += cumulative[b] < target
+        upto = np.take_along_axis(cumulative, k[np.newaxis], 0)[0]
+        below = np.where(k > 0, np.take_along_axis(cumulative, np.maximum(k - 1, 0)[np.newaxis], 0)[0], 0)
+        in_bin = np.maximum(upto - below, 1)
+        return lower + (k + (target - below) / in_bin) * step
+
+    for q in percentiles:
+        # linear interpolation between order statistics at rank q*(n-1), as numpy.percentile
+        rank = q / 100.0 * np.maximum(count - 1, 0)
+        low = np.floor(rank)
+        value = order_statistic(low)
+        value = value + (rank - low) * (order_statistic(np.minimum(low + 1, np.maximum(count - 1, 0))) - value)
+        stats[f'p{q:g}'] = np.where(count > 0, np.where(vmax > vmin, value, vmin), np.nan)
+    return stats, count
+
+
+def ensemble_statistics(member_paths, output_path, variable, percentiles=None, bins=DEFAULT_HISTOGRAM_BINS,
+                        memory_budget_mb=DEFAULT_ENSEMBLE_MEMORY_MB):
+    """
+    Writes the ensemble summary (mean, std, min, max, percentiles and the member
+    count per cell) of one variable over per-member files of the same period.
+
+    Members are streamed one time block at a time and each block's statistics
+    are written to the output before the next block is read: only one block,
+    sized to 'memory_budget_mb', is held in memory, whatever the member count
+    and the length of the period. Blocks run along 'time', or along the leading dimension
+    of products without one (e.g. 'month' of a climatology). Members whose axis
+    differs from the first one are skipped. Returns the output path, or None on failure.
+    """
+    percentiles = DEFAULT_PERCENTILES if percentiles is None else percentiles
+    datasets = []
+    try:
+        for path in member_paths:
+            datasets.append(xr.open_dataset(path))
+        template = datasets[0]
+        da = template[variable]
+        axis = 'time' if 'time' in da.dims else da.dims[0]
+        members = []
+        for path, ds in zip(member_paths, datasets):
+            if ds.sizes[axis] != template.sizes[axis] or not np.array_equal(ds[axis].values, template[axis].values):
+                logging.warning(f"Skipping ensemble member with a different {axis} axis: {path}")
+                continue
+            members.append((path, ds))
+
+        n_steps = template.sizes[axis]
+        block = _block_size(da.size // max(n_steps, 1), bins, memory_budget_mb)
+        logging.info(f"Ensemble statistics of {len(members)} members in blocks of {block} {axis} steps: {output_path}")
+
+        # coordinates and global attributes are encoded by xarray; the statistics
+        # are then filled in one block at a time with netCDF4
+        import netCDF4
+        header = xr.Dataset(coords={name: template[name] for name in da.dims})
+        header.attrs = dict(template.attrs)
+        header.attrs['ensemble_members'] = ' '.join(sorted(os.path.basename(path).split('_')[4] for path, _ in members))
+        header.attrs['ensemble_member_count'] = len(members)
+        tmp_path = output_path + '.tmp'
+        header.to_netcdf(tmp_path)
+
+        var_attrs = {key: value for key, value in da.attrs.items() if key in ('units', 'long_name', 'standard_name')}
+        with netCDF4.Dataset(tmp_path, 'a') as nc:
+            for start in range(0, n_steps, block):
+                block_slice = slice(start, start + block)
+
+                def member_blocks():
+                    for _, ds in members:
+                        yield ds[variable].isel({axis: block_slice}).transpose(*da.dims).values.astype('float64')
+
+                stats, count = _block_statistics(member_blocks, percentiles, bins)
+                values = {'member_count': count.astype('int16')}
+                values.update((f"{variable}_{name}", stat.astype('float32')) for name, stat in stats.items())
+
+                index = tuple(block_slice if dim == axis else slice(None) for dim in da.dims)
+                for name, data in values.items():
+                    if name not in nc.variables:
+                        is_count = name == 'member_count'
+                        out = nc.createVariable(name, data.dtype, da.dims, zlib=True, complevel=4,
+                                                fill_value=False if is_count else np.float32(np.nan))
+                        if not is_count:
+                            out.setncatts(dict(var_attrs, cell_methods=f"realization: {name[len(variable) + 1:]}"))
+                    nc.variables[name][index] = data
+        os.replace(tmp_path, output_path)
+        logging.info(f"Successfully wrote ensemble summary: {output_path}")
+        return output_path
+    except Exception as e:
+        logging.error(f"Could not compute ensemble statistics for {output_path}. Error: {e}")
+        if os.path.exists(output_path + '.tmp'):
+            os.remove(output_path + '.tmp')
+        return None
+    finally:
+        for ds in datasets:
+            ds.close()
+
+
+def ensemble_is_current(output_path, member_paths):
+    """True if the ensemble product exists, is newer than every member file and was computed from exactly these members"""
+    if not os.path.exists(output_path):
+        return False
+    # a reprocessed member is newer than the summary computed from it
+    if any(os.path.getmtime(path) > os.path.getmtime(output_path) for path in member_paths):
+        return False
+    try:
+        with xr.open_dataset(output_path) as ds:
+            stored = ds.attrs.get('ensemble_members', '').split()
+    except Exception:
+        return False
+    return sorted(stored) == sorted(os.path.basename(path).split('_')[4] for path in member_paths)
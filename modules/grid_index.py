@@ -0,0 +1,206 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import numpy as np
+import xarray as xr
+
+# bump whenever the layout of cached entries changes, so old cache files are rebuilt
+CACHE_FORMAT_VERSION = 2
+
+
+def coord_index_slice(values, lower, upper):
+    """
+    Returns the positional slice of a monotonic 1D coordinate whose values fall
+    within [lower, upper], i.e. the same cells label-based .sel(slice(lower, upper))
+    selects on an ascending coordinate.
+    """
+    values = np.asarray(values)
+    if len(values) > 1 and values[0] > values[-1]:
+        # descending coordinate (e.g. latitude stored north to south)
+        reversed_values = values[::-1]
+        start = len(values) - np.searchsorted(reversed_values, upper, side='right')
+        stop = len(values) - np.searchsorted(reversed_values, lower, side='left')
+        return slice(int(start), int(stop))
+    start = np.searchsorted(values, lower, side='left')
+    stop = np.searchsorted(values, upper, side='right')
+    return slice(int(start), int(stop))
+
+
+def lon_index_blocks(values, west, east):
+    """
+    Returns the positional slices of an ascending longitude coordinate that fall
+    within [west, east], whatever convention the grid and the box use.
+
+    Works for 0-360 grids with negative bounds (e.g. Latin_America -118 to -34),
+    -180-180 grids with bounds above 180, and boxes crossing the 0/360 or 180
+    seam (e.g. West_Africa -20 to 20 on a 0-360 grid, or 170 to -170). A box
+    crossing the seam yields two blocks, ordered so that joining them gives
+    longitudes increasing eastward from the box's western edge.
+    """
+    values = np.asarray(values, dtype='float64')
+    if east < west:
+        # box written across the antimeridian, e.g. 170 to -170
+        east += 360.0
+    width = east - west
+    if width >= 360.0:
+        return [slice(0, len(values))]
+
+    # distance of every cell eastward from the western edge, in [0, 360)
+    offsets = np.mod(values - west, 360.0)
+    inside = offsets <= width
+
+    # contiguous runs of in-box cells (at most two on a global grid)
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], inside.astype(np.int8), [0]))))
+    blocks = [slice(int(start), int(stop)) for start, stop in zip(edges[::2], edges[1::2])]
+    blocks.sort(key=lambda block: offsets[block.start])
+    return blocks
+
+
+def grid_signature(lat_values, lon_values):
+    """Fingerprints a grid from its lat/lon coordinate values (e.g. ESM4 'gr1' vs SPEAR 'gr3')"""
+    hasher = hashlib.sha1()
+    for values in (lat_values, lon_values):
+        values = np.ascontiguousarray(values, dtype='float64')
+        hasher.update(str(values.shape).encode())
+        hasher.update(values.tobytes())
+    return hasher.hexdigest()[:16]
+
+
+def regions_signature(processing_regions):
+    """Fingerprints the 'processing_regions' config so the cache is dropped when it changes"""
+    payload = json.dumps({'version': CACHE_FORMAT_VERSION, 'regions': processing_regions}, sort_keys=True)
+    return hashlib.sha1(payload.encode()).hexdigest()[:16]
+
+
+def _scope_key(geo_scope):
+    """Cache key for a bounding box"""
+    return f"{geo_scope['min_lat']},{geo_scope['max_lat']},{geo_scope['min_lon']},{geo_scope['max_lon']}"
+
+
+class GridIndexCache:
+    """
+    Caches the integer index ranges of each region's bounding box per distinct grid.
+
+    There are only a handful of grids in the mirror and the regions rarely change,
+    so instead of a label-based .sel() lookup for every file and region we
+    fingerprint the file's lat/lon coordinates once and reuse positional slices
+    for .isel(). The cache is persisted as JSON and discarded as a whole when
+    the 'processing_regions' config no longer matches the one it was built for.
+    """
+
+    def __init__(self, cache_path, processing_regions):
+        self.cache_path = cache_path
+        self.signature = regions_signature(processing_regions)
+        self._lock = threading.Lock()
+        self._grids = self._load()
+
+    def __getstate__(self):
+        # locks cannot be pickled; each worker process gets its own
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not read grid index cache at '{self.cache_path}', rebuilding. Reason: {e}")
+            return {}
+        if data.get('regions_signature') != self.signature:
+            logging.info("processing_regions changed since the grid index cache was built; rebuilding it.")
+            return {}
+        return data.get('grids', {})
+
+    def _save(self):
+        if not self.cache_path:
+            return
+        # unique temporary name: worker processes may save the same cache concurrently
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'regions_signature': self.signature, 'grids': self._grids}, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def slices(self, lat_values, lon_values, geo_scope):
+        """Returns {'lat': slice, 'lon': [slice, ...]} selecting the bounding box on this grid"""
+        grid_key = grid_signature(lat_values, lon_values)
+        scope_key = _scope_key(geo_scope)
+
+        with self._lock:
+            entry = self._grids.get(grid_key, {}).get(scope_key)
+            if entry is None:
+                lat_slice = coord_index_slice(lat_values, geo_scope['min_lat'], geo_scope['max_lat'])
+                lon_blocks = lon_index_blocks(lon_values, geo_scope['min_lon'], geo_scope['max_lon'])
+                entry = {
+                    'lat': [lat_slice.start, lat_slice.stop],
+                    'lon': [[block.start, block.stop] for block in lon_blocks]
+                }
+                self._grids.setdefault(grid_key, {})[scope_key] = entry
+                self._save()
+
+        return {'lat': slice(*entry['lat']), 'lon': [slice(*block) for block in entry['lon']]}
+
+    def dataset_slices(self, ds, geo_scope):
+        """Convenience wrapper taking an open xarray dataset with 'lat'/'lon' coordinates"""
+        return self.slices(ds['lat'].values, ds['lon'].values, geo_scope)
+
+
+def region_slices(ds, geo_scope, index_cache=None):
+    """
+    Returns the positional slices of a bounding box as {'lat': slice, 'lon': [slice, ...]},
+    using the cache when one is given. 'lon' holds two blocks when the box crosses the seam.
+    """
+    if index_cache is not None:
+        return index_cache.dataset_slices(ds, geo_scope)
+    return {
+        'lat': coord_index_slice(ds['lat'].values, geo_scope['min_lat'], geo_scope['max_lat']),
+        'lon': lon_index_blocks(ds['lon'].values, geo_scope['min_lon'], geo_scope['max_lon'])
+    }
+
+
+def _relabel_longitudes(subset, west):
+    """
+    Shifts longitudes by multiples of 360 into the bounding box's own convention
+    (e.g. 242.5 -> -117.5 for Latin_America), so the joined blocks are monotonic.
+    Longitude bounds named by the CF 'bounds' attribute are shifted with their cells.
+    """
+    lon_values = subset['lon'].values
+    wraps = np.floor((lon_values - west) / 360.0)
+    if not wraps.any():
+        return subset
+
+    lon_attrs = subset['lon'].attrs
+    subset = subset.assign_coords(lon=('lon', (lon_values - 360.0 * wraps).astype(lon_values.dtype), lon_attrs))
+
+    bounds_name = lon_attrs.get('bounds')
+    if bounds_name in subset.variables:
+        bounds = subset[bounds_name]
+        shift = xr.DataArray(360.0 * wraps, dims='lon')
+        subset[bounds_name] = bounds.copy(data=(bounds - shift).transpose(*bounds.dims).values)
+    return subset
+
+
+def subset_region(ds, geo_scope, index_cache=None):
+    """
+    Cuts a bounding box out of a dataset with positional indexing.
+
+    Only the needed longitude blocks are read: a box crossing the 0/360 or 180
+    seam is assembled from its two blocks instead of rolling the global array,
+    and the output longitudes follow the bounding box's convention.
+    """
+    slices = region_slices(ds, geo_scope, index_cache)
+    lon_blocks = slices['lon'] or [slice(0, 0)]
+    parts = [ds.isel(lat=slices['lat'], lon=block) for block in lon_blocks]
+    if len(parts) == 1:
+        subset = parts[0]
+    else:
+        subset = xr.concat(parts, dim='lon', data_vars='minimal', coords='minimal', compat='override')
+    return _relabel_longitudes(subset, geo_scope['min_lon'])
@@ -0,0 +1,209 @@
+import time
+import random
+import logging
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+import requests
+
+# --- default per-host policy (overridable from config.yaml 'download_settings.hosts') ---
+DEFAULT_HOST_SETTINGS = {
+    'max_connections': 4,      # concurrent connections to the host, segments included
+    'bandwidth_mb_s': None,    # MB/s across all connections to the host, None = unlimited
+    'connect_timeout_s': 15,
+    'read_timeout_s': 60,      # longest silence on an open connection
+    'retries': 4,              # retries of a transient error (the .part file is resumed)
+    'backoff_base_s': 2.0,     # the n-th retry waits a random time up to base * 2**n ...
+    'backoff_max_s': 120.0,    # ... capped at this
+    'failure_threshold': 5,    # consecutive transient failures that open the circuit
+    'cooldown_s': 300          # how long an open circuit rejects requests before one trial
+}
+
+# HTTP statuses worth retrying; anything else (404, 403, ...) is final
+RETRY_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(requests.RequestException):
+    """Raised instead of contacting a host whose circuit breaker is open"""
+
+
+class IncompleteDownloadError(requests.RequestException):
+    """The connection ended before the full file arrived; retried like a dropped connection"""
+
+
+def is_transient(error):
+    """True for errors that a later attempt can fix: dropped connections, timeouts, 429/5xx"""
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code in RETRY_STATUS_CODES
+    return isinstance(error, (
+        requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+        IncompleteDownloadError
+    ))
+
+
+def _retry_after(error):
+    """Seconds requested by a 429/503 'Retry-After' header, if any"""
+    response = getattr(error, 'response', None)
+    value = response.headers.get('Retry-After') if response is not None else None
+    return float(value) if value and value.isdigit() else None
+
+
+class HostState:
+    """
+    Limits and health of one host: a semaphore bounding its concurrent
+    connections, a token bucket bounding its bandwidth and a circuit breaker
+    that stops sending requests to it after repeated transient failures.
+    """
+
+    def __init__(self, host, settings):
+        self.host = host
+        self.settings = settings
+        self.timeout = (settings['connect_timeout_s'], settings['read_timeout_s'])
+        self._connections = threading.BoundedSemaphore(settings['max_connections'])
+        self._lock = threading.Lock()
+        # token bucket, one second of burst
+        self._rate = settings['bandwidth_mb_s'] * 1024**2 if settings['bandwidth_mb_s'] else None
+        self._tokens = self._rate or 0.0
+        self._last_refill = time.monotonic()
+        # circuit breaker: closed -> open after 'failure_threshold' failures -> half open after 'cooldown_s'
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    @contextmanager
+    def connection(self):
+        """Holds one of the host's connection slots"""
+        with self._connections:
+            yield
+
+    def throttle(self, nbytes):
+        """Waits as long as needed to keep the host within its bandwidth limit"""
+        if not self._rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._rate, self._tokens + (now - self._last_refill) * self._rate)
+            self._last_refill = now
+            self._tokens -= nbytes
+            deficit = -self._tokens
+        if deficit > 0:
+            time.sleep(deficit / self._rate)
+
+    def before_request(self):
+        """
+        Raises CircuitOpenError while the circuit is open; lets one trial through
+        after the cooldown. Returns True for the trial, which must be ended with end_trial().
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            if time.monotonic() - self._opened_at < self.settings['cooldown_s'] or self._trial_running:
+                raise CircuitOpenError(f"Circuit open for {self.host} after {self._failures} consecutive failures")
+            self._trial_running = True
+            logging.info(f"Circuit half-open for {self.host}: trying one request.")
+            return True
+
+    def end_trial(self):
+        """Lets the next request try the host, whatever the outcome of the trial"""
+        with self._lock:
+            self._trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logging.info(f"Circuit closed for {self.host}: host is responding again.")
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or (self._opened_at is None and self._failures >= self.settings['failure_threshold']):
+                logging.warning(
+                    f"Circuit OPEN for {self.host} after {self._failures} consecutive failures; "
+                    f"pausing it for {self.settings['cooldown_s']} s while other hosts continue."
+                )
+                self._opened_at = time.monotonic()
+                self._trial_running = False
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+
+class HostScheduler:
+    """
+    Applies per-host policies to downloads. 'host_settings' maps a host name
+    (or 'host:port') to overrides of DEFAULT_HOST_SETTINGS; a 'default' entry
+    applies to every host not listed. A slow or failing host only uses its own
+    connection slots and trips its own circuit breaker, so transfers from the
+    other hosts go on.
+    """
+
+    def __init__(self, host_settings=None):
+        host_settings = dict(host_settings or {})
+        self._default = {**DEFAULT_HOST_SETTINGS, **(host_settings.pop('default', None) or {})}
+        self._overrides = host_settings
+        self._hosts = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def host(self, url):
+        """Returns the HostState of a URL's host; servers on different ports of a host are kept apart"""
+        parts = urlsplit(url)
+        name = parts.netloc.rpartition('@')[2]
+        with self._lock:
+            state = self._hosts.get(name)
+            if state is None:
+                overrides = self._overrides.get(name) or self._overrides.get(parts.hostname) or {}
+                state = HostState(name, {**self._default, **overrides})
+                self._hosts[name] = state
+            return state
+
+    def take_retries(self):
+        """Returns and resets the number of retries made by the calling thread"""
+        retries = getattr(self._local, 'retries', 0)
+        self._local.retries = 0
+        return retries
+
+    def request(self, url, func):
+        """
+        Calls func(host_state) with retries: transient errors are retried with
+        exponential backoff and full jitter (or the server's Retry-After), and
+        count towards the host's circuit breaker. Other errors are raised at once.
+        """
+        state = self.host(url)
+        retries = state.settings['retries']
+        for attempt in range(retries + 1):
+            trial = state.before_request()
+            try:
+                result = func(state)
+            except Exception as e:
+                if not is_transient(e):
+                    # e.g. a 404: the host answered, so it counts as healthy
+                    if isinstance(e, requests.HTTPError):
+                        state.record_success()
+                    raise
+                state.record_failure()
+                if attempt == retries or state.is_open:
+                    raise
+                backoff_max = state.settings['backoff_max_s']
+                retry_after = _retry_after(e)
+                if retry_after is not None:
+                    delay = min(retry_after, backoff_max)
+                else:
+                    delay = random.uniform(0, min(backoff_max, state.settings['backoff_base_s'] * 2 ** attempt))
+                self._local.retries = getattr(self._local, 'retries', 0) + 1
+                logging.warning(f"Transient error from {state.host} ({e}); retry {attempt + 1}/{retries} in {delay:.1f} s: {url}")
+                time.sleep(delay)
+            else:
+                state.record_success()
+                return result
+            finally:
+                # an unexpected error (e.g. a full disk) must not leave the circuit stuck half open
+                if trial:
+                    state.end_trial()
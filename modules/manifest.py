@@ -0,0 +1,205 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+import xarray as xr
+from concurrent.futures import ThreadPoolExecutor
+from modules.downloader import PART_SUFFIX, read_checksum_sidecar
+from modules.zarr_store import ingested_periods
+
+# status values stored for raw files and processed outputs
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+# number of threads verifying files while rebuilding the manifest from a scan
+DEFAULT_SCAN_WORKERS = 8
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS raw_files (
+    path TEXT PRIMARY KEY,
+    file_name TEXT NOT NULL,
+    url TEXT,
+    size INTEGER,
+    checksum TEXT,
+    checksum_type TEXT,
+    status TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS raw_files_name ON raw_files (file_name, status);
+CREATE TABLE IF NOT EXISTS outputs (
+    path TEXT PRIMARY KEY,
+    raw_file TEXT NOT NULL,
+    region TEXT,
+    backend TEXT NOT NULL,
+    size INTEGER,
+    status TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+def _is_complete_netcdf(path):
+    """
+    True if a NetCDF file can be opened and its last time step read. A truncated
+    file either fails to open (HDF5) or fails on its final records (classic format)
+    """
+    try:
+        with xr.open_dataset(path, decode_times=False) as ds:
+            if 'time' in ds.dims and ds.sizes['time']:
+                ds.isel(time=-1).load()
+        return True
+    except Exception as e:
+        logging.warning(f"Ignoring unreadable or truncated file during manifest scan: {path}. Reason: {e}")
+        return False
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+class Manifest:
+    """
+    Local SQLite record of every raw file and processed output the pipeline has
+    produced, with its size, checksum, status and timestamp.
+
+    Deciding what is already done is then one query per table at the start of a
+    run, instead of a stat call per candidate file and region on the datalake.
+    Files only count as done once they were completely written, so a truncated
+    file is never skipped. Keep the database on a local disk: SQLite locking is
+    unreliable on network mounts.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.is_new = not os.path.exists(db_path)
+        # one connection shared by the main thread and the processing callbacks
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # --- recording ---
+    def record_raw_file(self, path, status, url=None, size=None, checksum=None, checksum_type=None):
+        """Records the outcome of a download"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO raw_files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (path, os.path.basename(path), url, size, checksum, checksum_type, status, time.time())
+            )
+
+    def record_outputs(self, raw_file_path, outputs, backend, status):
+        """Records processed outputs given as (path, region_name) pairs"""
+        now = time.time()
+        rows = [
+            (path, os.path.basename(raw_file_path), region, backend,
+             _file_size(path) if status == STATUS_DONE and backend != 'zarr' else None, status, now)
+            for path, region in outputs
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    # --- planning ---
+    def done_raw_files(self):
+        """Returns {file_name: path} of every completely downloaded raw file"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT file_name, path FROM raw_files WHERE status = ?", (STATUS_DONE,)
+            ).fetchall()
+        return dict(rows)
+
+    def raw_checksums(self):
+        """Returns {path: checksum} of every completely downloaded raw file with a known checksum"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path, checksum FROM raw_files WHERE status = ? AND checksum IS NOT NULL", (STATUS_DONE,)
+            ).fetchall()
+        return dict(rows)
+
+    def done_outputs(self, backend):
+        """Returns the set of output paths already written with the given backend"""
+        backends = ('netcdf', 'zarr', 'both') if backend == 'both' else (backend, 'both')
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path, backend FROM outputs WHERE status = ?", (STATUS_DONE,)
+            ).fetchall()
+        if backend != 'both':
+            return {path for path, stored in rows if stored in backends}
+        # 'both' needs every path written by each backend (or once by 'both')
+        by_path = {}
+        for path, stored in rows:
+            by_path.setdefault(path, set()).update(('netcdf', 'zarr') if stored == 'both' else (stored,))
+        return {path for path, stored in by_path.items() if stored >= {'netcdf', 'zarr'}}
+
+    # --- rebuild ---
+    def rebuild(self, raw_dir, base_path, processing_regions, max_workers=DEFAULT_SCAN_WORKERS):
+        """
+        Rebuilds the manifest from a scan of the existing tree: the raw staging
+        directory and every region directory under base_path. Raw files with a
+        checksum sidecar were completed by the downloader and are trusted; other
+        NetCDF files are only recorded if they can be read to the end. Zarr stores
+        contribute one output per ingested period.
+        """
+        logging.info(f"Rebuilding state manifest {self.db_path} from a scan of {base_path}")
+
+        raw_paths = []
+        if os.path.isdir(raw_dir):
+            raw_paths = [
+                os.path.join(raw_dir, name) for name in os.listdir(raw_dir)
+                if name.endswith('.nc') and not name.endswith(PART_SUFFIX)
+            ]
+
+        netcdf_outputs, zarr_outputs = [], []
+        for region in processing_regions:
+            region_dir = os.path.join(base_path, region['name'])
+            for root, dirs, files in os.walk(region_dir):
+                for name in [d for d in dirs if d.endswith('.zarr')]:
+                    # do not descend into the store's chunk tree
+                    dirs.remove(name)
+                    store_path = os.path.join(root, name)
+                    stem = name[:-len('.zarr')]
+                    for period in ingested_periods(store_path):
+                        zarr_outputs.append((os.path.join(root, f"{stem}_{period}.nc"), region['name']))
+                netcdf_outputs.extend((os.path.join(root, name), region['name']) for name in files if name.endswith('.nc'))
+
+        def _raw_row(path):
+            sidecar = read_checksum_sidecar(path)
+            if sidecar is None and not _is_complete_netcdf(path):
+                return None
+            checksum_type, checksum = sidecar or (None, None)
+            return (path, os.path.basename(path), None, _file_size(path), checksum, checksum_type, STATUS_DONE, time.time())
+
+        def _netcdf_output_row(job):
+            path, region = job
+            if not _is_complete_netcdf(path):
+                return None
+            return (path, os.path.basename(path), region, 'netcdf', _file_size(path), STATUS_DONE, time.time())
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            raw_rows = [row for row in executor.map(_raw_row, raw_paths) if row]
+            output_rows = {row[0]: row for row in executor.map(_netcdf_output_row, netcdf_outputs) if row}
+
+        for path, region in zarr_outputs:
+            if path in output_rows:
+                output_rows[path] = output_rows[path][:3] + ('both',) + output_rows[path][4:]
+            else:
+                output_rows[path] = (path, os.path.basename(path), region, 'zarr', None, STATUS_DONE, time.time())
+
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM raw_files")
+            self._conn.execute("DELETE FROM outputs")
+            self._conn.executemany("INSERT INTO raw_files VALUES (?, ?, ?, ?, ?, ?, ?, ?)", raw_rows)
+            self._conn.executemany("INSERT INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?)", output_rows.values())
+
+        logging.info(f"Manifest rebuilt: {len(raw_rows)} raw files and {len(output_rows)} processed outputs recorded.")
@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+
+# labels every metric is broken down by
+METRIC_LABELS = ('stage', 'dataset', 'group', 'variable')
+
+# the Prometheus textfile is rewritten at most this often while a run is in progress
+DEFAULT_PROMETHEUS_INTERVAL = 60
+
+# rows of the end-of-run summary table
+DEFAULT_SUMMARY_TOP = 10
+
+
+def timed_call(func, *args):
+    """Worker: calls func(*args) and returns (result, seconds), so a pool caller can time the work itself"""
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsRecorder:
+    """
+    Collects one event per unit of work of the download, process and validate
+    stages: wall time, bytes in and out, throughput, retries, queue depth and
+    status, labelled by dataset, group and variable.
+
+    Every event is appended to a JSON-lines file as it happens; totals per
+    stage and labels are exported to a Prometheus textfile (for the
+    node_exporter textfile collector) during and at the end of the run, and
+    summary() logs the stages that took the longest. Safe to use from the
+    download threads and the process pool callbacks.
+    """
+
+    def __init__(self, jsonl_path=None, prometheus_path=None, job='pipeline', prometheus_interval=DEFAULT_PROMETHEUS_INTERVAL):
+        self.job = job
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.prometheus_interval = prometheus_interval
+        self.run_id = uuid.uuid4().hex[:12]
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._totals = {}
+        self._queue_depth = {}
+        self._last_export = 0.0
+        self._jsonl = None
+        for path in (jsonl_path, prometheus_path):
+            if path and os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+        if jsonl_path:
+            self._jsonl = open(jsonl_path, 'a', buffering=1)
+
+    def record(self, stage, seconds, bytes_in=0, bytes_out=0, status='done', retries=0, queue_depth=None,
+               dataset=None, group=None, variable=None, **details):
+        """Records one finished unit of work, e.g. one downloaded or processed file"""
+        event = {
+            'run_id': self.run_id,
+            'job': self.job,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'stage': stage, 'dataset': dataset, 'group': group, 'variable': variable,
+            'status': status,
+            'seconds': round(seconds, 3),
+            'bytes_in': int(bytes_in), 'bytes_out': int(bytes_out),
+            'mb_per_s': round(bytes_in / 1024**2 / seconds, 2) if seconds and bytes_in else None,
+            'retries': retries,
+            'queue_depth': queue_depth
+        }
+        event.update(details)
+
+        key = (stage, dataset, group, variable)
+        with self._lock:
+            totals = self._totals.setdefault(key, {
+                'count': 0, 'failed': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'bytes_in': 0, 'bytes_out': 0, 'retries': 0
+            })
+            totals['count'] += 1
+            totals['failed'] += status == 'failed'
+            totals['seconds'] += seconds
+            totals['max_seconds'] = max(totals['max_seconds'], seconds)
+            totals['bytes_in'] += int(bytes_in)
+            totals['bytes_out'] += int(bytes_out)
+            totals['retries'] += retries
+            if queue_depth is not None:
+                self._queue_depth[stage] = queue_depth
+            if self._jsonl:
+                self._jsonl.write(json.dumps(event) + '\n')
+            if self.prometheus_path and time.time() - self._last_export >= self.prometheus_interval:
+                self._write_prometheus()
+
+    def _write_prometheus(self):
+        """Writes the totals in the Prometheus text format, atomically. Caller holds the lock"""
+        lines = []
+        counters = [
+            ('gfdl_stage_seconds_total', 'Wall time spent per stage', 'seconds'),
+            ('gfdl_stage_bytes_in_total', 'Bytes read per stage', 'bytes_in'),
+            ('gfdl_stage_bytes_out_total', 'Bytes written per stage', 'bytes_out'),
+            ('gfdl_stage_events_total', 'Units of work finished per stage', 'count'),
+            ('gfdl_stage_failures_total', 'Units of work failed per stage', 'failed'),
+            ('gfdl_stage_retries_total', 'Retries per stage', 'retries'),
+        ]
+        for name, help_text, field in counters:
+            lines.append(f"# HELP {name} {help_text}.")
+            lines.append(f"# TYPE {name} counter")
+            for key, totals in sorted(self._totals.items(), key=lambda item: tuple(str(k) for k in item[0])):
+                labels = ','.join(
+                    [f'job="{_escape(self.job)}"'] + [f'{label}="{_escape(value or "")}"' for label, value in zip(METRIC_LABELS, key)]
+                )
+                value = totals[field]
+                lines.append(f"{name}{{{labels}}} {value if isinstance(value, int) else round(value, 3)}")
+
+        lines.append("# HELP gfdl_stage_queue_depth Items waiting for the stage at the last event.")
+        lines.append("# TYPE gfdl_stage_queue_depth gauge")
+        for stage, depth in sorted(self._queue_depth.items()):
+            lines.append(f'gfdl_stage_queue_depth{{job="{_escape(self.job)}",stage="{_escape(stage)}"}} {depth}')
+
+        lines.append("# HELP gfdl_pipeline_run_started_seconds Start of the current run (unix time).")
+        lines.append("# TYPE gfdl_pipeline_run_started_seconds gauge")
+        lines.append(f'gfdl_pipeline_run_started_seconds{{job="{_escape(self.job)}",run_id="{self.run_id}"}} {self.started:.0f}')
+        lines.append("# HELP gfdl_pipeline_run_seconds Wall time of the current run so far.")
+        lines.append("# TYPE gfdl_pipeline_run_seconds gauge")
+        lines.append(f'gfdl_pipeline_run_seconds{{job="{_escape(self.job)}",run_id="{self.run_id}"}} {time.time() - self.started:.1f}')
+
+        tmp_path = f"{self.prometheus_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.prometheus_path)
+        self._last_export = time.time()
+
+    def totals(self):
+        """Returns a copy of the totals per (stage, dataset, group, variable)"""
+        with self._lock:
+            return {key: dict(totals) for key, totals in self._totals.items()}
+
+    def summary(self, top=DEFAULT_SUMMARY_TOP):
+        """Logs a table of the stage/dataset/group/variable combinations with the most wall time"""
+        with self._lock:
+            rows = sorted(self._totals.items(), key=lambda item: item[1]['seconds'], reverse=True)[:top]
+        if not rows:
+            return
+        logging.info(f"--- Slowest stages ({self.job} run {self.run_id}, {time.time() - self.started:.0f} s) ---")
+        logging.info(f"{'stage':<10} {'dataset':<24} {'group':<14} {'variable':<10} {'files':>6} {'failed':>6} {'total s':>10} {'max s':>8} {'MB/s':>8}")
+        for (stage, dataset, group, variable), totals in rows:
+            mb_per_s = totals['bytes_in'] / 1024**2 / totals['seconds'] if totals['seconds'] else 0.0
+            logging.info(
+                f"{stage:<10} {dataset or '-':<24} {group or '-':<14} {variable or '-':<10} {totals['count']:>6} "
+                f"{totals['failed']:>6} {totals['seconds']:>10.1f} {totals['max_seconds']:>8.1f} {mb_per_s:>8.1f}"
+            )
+
+    def close(self):
+        """Writes the final Prometheus textfile and closes the JSON-lines file"""
+        with self._lock:
+            if self.prometheus_path:
+                self._write_prometheus()
+            if self._jsonl:
+                self._jsonl.close()
+                self._jsonl = None
+
+
+def metrics_recorder(config, base_path, job):
+    """
+    Builds the MetricsRecorder of a job ('pipeline', 'validation') from the
+    'metrics_settings' config. Every job appends to the same JSON-lines file but
+    has its own Prometheus textfile ('gfdl_<job>.prom'), so concurrent jobs do
+    not overwrite each other. When metrics are disabled the recorder only keeps
+    the totals for the end-of-run summary.
+    """
+    settings = config.get('metrics_settings', {})
+    if not settings.get('enabled', False):
+        return MetricsRecorder(job=job)
+    jsonl_path = os.path.join(base_path, os.path.expanduser(settings.get('jsonl_file', 'metrics/metrics.jsonl')))
+    prometheus_dir = os.path.join(base_path, os.path.expanduser(settings.get('prometheus_dir', 'metrics')))
+    return MetricsRecorder(
+        jsonl_path, os.path.join(prometheus_dir, f"gfdl_{job}.prom"), job,
+        settings.get('prometheus_interval_s', DEFAULT_PROMETHEUS_INTERVAL)
+    )
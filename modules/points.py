@@ -0,0 +1,165 @@
+import os
+import json
+import logging
+import threading
+import numpy as np
+import pandas as pd
+import xarray as xr
+from modules.grid_index import grid_signature
+from modules.query import find_files
+from modules.zarr_store import zarr_store_path
+
+
+def nearest_cell(lat_values, lon_values, lat, lon):
+    """
+    Returns the (lat_index, lon_index) of the grid cell nearest to a point, or None
+    if the point lies more than one cell outside the grid. Longitudes are compared
+    on the circle, so -46.6 finds 313.4 on a 0-360 grid and vice versa.
+    """
+    lat_values = np.asarray(lat_values, dtype='float64')
+    lon_values = np.asarray(lon_values, dtype='float64')
+    lat_distance = np.abs(lat_values - lat)
+    lon_distance = np.abs((lon_values - lon + 180.0) % 360.0 - 180.0)
+    i, j = int(lat_distance.argmin()), int(lon_distance.argmin())
+
+    # one grid spacing of tolerance: beyond that the point is not on this (regional) grid
+    lat_step = np.abs(np.diff(lat_values)).max() if len(lat_values) > 1 else 180.0
+    lon_step = np.abs(np.diff(lon_values)).max() if len(lon_values) > 1 else 360.0
+    if lat_distance[i] > lat_step or lon_distance[j] > lon_step:
+        return None
+    return i, j
+
+
+class PointIndexCache:
+    """
+    Caches the nearest-cell indexes of lat/lon points per distinct grid, in the
+    same way GridIndexCache does for region boxes: the handful of regional grids
+    are fingerprinted once, so repeated extractions skip the nearest-cell search.
+    """
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+        self._grids = self._load()
+
+    def _load(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not read point index cache at '{self.cache_path}', rebuilding. Reason: {e}")
+            return {}
+
+    def _save(self):
+        if not self.cache_path:
+            return
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self._grids, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def cells(self, lat_values, lon_values, points):
+        """Returns the nearest (i, j) (or None) of every (lat, lon) point on this grid"""
+        grid_key = grid_signature(lat_values, lon_values)
+        with self._lock:
+            entries = self._grids.setdefault(grid_key, {})
+            missing = [p for p in points if f"{p[0]},{p[1]}" not in entries]
+            for lat, lon in missing:
+                entries[f"{lat},{lon}"] = nearest_cell(lat_values, lon_values, lat, lon)
+            if missing:
+                self._save()
+            return [tuple(entries[f"{lat},{lon}"]) if entries[f"{lat},{lon}"] else None for lat, lon in points]
+
+
+def _extract_cells(ds, variable, cells, start=None, end=None):
+    """
+    Reads the time series of the given grid cells from an open dataset. Every cell
+    is read with basic indexing (one lat, one lon), so only the chunks holding
+    that cell are touched instead of the whole spatial slab.
+    Returns (times, values) with values shaped (cell, time).
+    """
+    da = ds[variable]
+    if start is not None or end is not None:
+        da = da.sel(time=slice(start, end))
+    columns = [da.isel(lat=i, lon=j) for i, j in cells]
+    if da.chunks:
+        # dask-backed (zarr): compute together so neighbouring points share chunk reads
+        import dask
+        values = np.stack(dask.compute(*[column.data for column in columns]))
+    else:
+        values = np.stack([column.values for column in columns])
+    return da['time'].values, values
+
+
+def extract_points(index_path, points, region, model, experiment, variable, frequency=None, member=None,
+                   start=None, end=None, point_cache=None, prefer_zarr=True, product=None):
+    """
+    Extracts the time series of many lat/lon points from the processed mirror.
+
+    'points' is a list of (name, lat, lon). Files are resolved through the catalog
+    query index; each point is mapped to its nearest grid cell through the
+    PointIndexCache and only those cells are read, per member and frequency, so
+    e.g. the 'day' and 'Amon' files of a member are never merged into one series.
+    If a member's time-major Zarr store exists next to its NetCDF files (output_backend 'zarr'
+    or 'both') it is read instead of the per-period files.
+    Ensemble-summary products are left out unless 'member' asks for them, and
+    temporal aggregates unless 'product' does (see find_files()).
+
+    Returns a long table with one row per point, member, frequency and time step:
+    point, member, frequency, lat, lon, cell_lat, cell_lon, time, value.
+    """
+    files = find_files(index_path, region, model, experiment, variable, frequency, member, start, end, product)
+    if not files:
+        raise ValueError(f"No processed files match {region}/{model}/{experiment}/{variable} for {start}..{end}.")
+
+    # each (member, frequency) is its own series, with its own Zarr store
+    by_series = {}
+    for f in files:
+        by_series.setdefault((f['member'], f['frequency']), []).append(f['path'])
+
+    point_cache = point_cache or PointIndexCache(None)
+    coordinates = [(lat, lon) for _, lat, lon in points]
+    tables = []
+
+    for (member_id, series_frequency), paths in by_series.items():
+        store_path = zarr_store_path(paths[0])
+        if prefer_zarr and os.path.isdir(store_path):
+            logging.info(f"Extracting {len(points)} points for {member_id} ({series_frequency}) from Zarr store: {store_path}")
+            sources = [xr.open_zarr(store_path)]
+        else:
+            logging.info(f"Extracting {len(points)} points for {member_id} ({series_frequency}) from {len(paths)} files.")
+            sources = (xr.open_dataset(path) for path in paths)
+
+        for ds in sources:
+            with ds:
+                cells = point_cache.cells(ds['lat'].values, ds['lon'].values, coordinates)
+                found = [(point, cell) for point, cell in zip(points, cells) if cell is not None]
+                if not found:
+                    continue
+                # each distinct cell is read once, however many points fall into it
+                unique_cells = sorted({cell for _, cell in found})
+                times, values = _extract_cells(ds, variable, unique_cells, start, end)
+                if not len(times):
+                    continue
+                rows = {cell: row for row, cell in enumerate(unique_cells)}
+                for (name, lat, lon), cell in found:
+                    tables.append(pd.DataFrame({
+                        'point': name, 'member': member_id, 'frequency': series_frequency, 'lat': lat, 'lon': lon,
+                        'cell_lat': float(ds['lat'].values[cell[0]]), 'cell_lon': float(ds['lon'].values[cell[1]]),
+                        'time': times, 'value': values[rows[cell]].astype('float32')
+                    }))
+
+    missing = {name for name, _, _ in points} - {t['point'].iat[0] for t in tables}
+    if missing:
+        logging.warning(f"Points outside the {region} grid, not extracted: {sorted(missing)}")
+    if not tables:
+        return pd.DataFrame(columns=['point', 'member', 'frequency', 'lat', 'lon', 'cell_lat', 'cell_lon', 'time', 'value'])
+
+    table = pd.concat(tables, ignore_index=True)
+    # categorical names keep the table compact for many points and long series
+    table['point'] = table['point'].astype('category')
+    table['member'] = table['member'].astype('category')
+    table['frequency'] = table['frequency'].astype('category')
+    return table.sort_values(['point', 'member', 'frequency', 'time'], ignore_index=True)
@@ -0,0 +1,117 @@
+import os
+import json
+import time
+import logging
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from modules.downloader import get_session
+from modules.hosts import HostScheduler
+
+# --- default probe settings (overridable from config.yaml 'probe_settings') ---
+DEFAULT_PROBE_WORKERS = 32
+DEFAULT_TTL_HOURS = 168  # re-probe known entries once a week
+
+# status codes that mean "this file definitely does not exist"
+MISSING_STATUS_CODES = (404, 410)
+
+
+def load_probe_cache(cache_path):
+    """Loads the on-disk probe cache, returning an empty cache if it is missing or unreadable"""
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read probe cache at '{cache_path}', starting fresh. Reason: {e}")
+        return {}
+
+
+def save_probe_cache(cache, cache_path):
+    """Writes the probe cache atomically so a crash never leaves a half-written file"""
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, cache_path)
+
+
+def probe_url(url, session=None, hosts=None):
+    """
+    Checks whether a URL exists with a cheap HEAD request, falling back to a
+    one-byte ranged GET for servers that do not answer HEAD properly. The
+    requests hold one of the host's connection slots ('hosts', a HostScheduler).
+    Returns True (exists), False (definitely missing) or None (unknown, e.g. timeout).
+    """
+    if session is None:
+        session = get_session()
+    if hosts is None:
+        hosts = HostScheduler()
+    try:
+        with hosts.host(url).connection():
+            return _probe(session, url)
+    except requests.RequestException as e:
+        logging.warning(f"Probe failed for {url}. Reason: {e}")
+        return None
+
+
+def _probe(session, url):
+    """HEAD request, then a one-byte GET if HEAD is not answered properly"""
+    r = session.head(url, timeout=30, allow_redirects=True)
+    if r.status_code in MISSING_STATUS_CODES:
+        return False
+    if r.ok:
+        return True
+
+    # some servers reject HEAD (e.g. 403/405) but serve GET, so ask for a single byte
+    with session.get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=30) as r:
+        if r.status_code in MISSING_STATUS_CODES:
+            return False
+        if r.ok:
+            return True
+    logging.warning(f"Probe returned HTTP {r.status_code} for {url}, treating as unknown.")
+    return None
+
+
+def probe_urls(urls, cache_path, ttl_hours=DEFAULT_TTL_HOURS, max_workers=DEFAULT_PROBE_WORKERS, hosts=None):
+    """
+    Probes candidate URLs in parallel and returns the subset that exists, in the original order.
+
+    Results are recorded in an on-disk cache; entries younger than 'ttl_hours'
+    are trusted without touching the network, so known-missing combinations are
+    skipped on later runs and only expired entries are re-probed. Unknown
+    results are not cached and the URL is kept as a candidate. Probes respect the
+    per-host connection limits of 'hosts' (a HostScheduler, as for downloads).
+    """
+    urls = list(urls)
+    cache = load_probe_cache(cache_path)
+    now = time.time()
+    ttl_seconds = ttl_hours * 3600
+
+    to_probe = [
+        url for url in urls
+        if url not in cache or now - cache[url]['checked'] > ttl_seconds
+    ]
+    logging.info(f"Probing {len(to_probe)} of {len(urls)} candidate URLs ({len(urls) - len(to_probe)} answered from cache).")
+
+    if hosts is None:
+        hosts = HostScheduler()
+
+    def _worker(url):
+        return probe_url(url, get_session(max_workers), hosts)
+
+    unknown = set()
+    if to_probe:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(_worker, url): url for url in to_probe}
+            for future in as_completed(futures):
+                url = futures[future]
+                exists = future.result()
+                if exists is None:
+                    unknown.add(url)
+                else:
+                    cache[url] = {'exists': exists, 'checked': now}
+        save_probe_cache(cache, cache_path)
+
+    existing = [url for url in urls if url in unknown or cache[url]['exists']]
+    logging.info(f"Probe stage kept {len(existing)} of {len(urls)} candidate URLs.")
+    return existing
@@ -2,29 +2,234 @@ import os
 import xarray as xr
 import logging
 import numpy as np
+from contextlib import nullcontext
+from modules.grid_index import subset_region
+from modules.zarr_store import zarr_store_path, period_from_filename, ingested_periods, append_to_zarr_store
+from modules.aggregation import source_frequency, aggregate_output_path, temporal_aggregates
 
-def process_netcdf_file(raw_file_path, processed_file_path, geo_scope):
+# headroom between the raw bytes of one time block and the peak memory of processing it
+# (read buffer, decoding/float promotion, encoding and compression of the output)
+MEMORY_SAFETY_FACTOR = 4
+
+def _packing_encoding(var, pack):
     """
-    Opens a raw NetCDF file, subsets it to the specified geographical scope and saves the result to a new file.
+    Returns the scale/offset encoding that packs a float variable into a small
+    integer type. The range comes from 'valid_min'/'valid_max' in the config, or
+    from the data itself when they are not given (in memory only: on a streamed,
+    dask-backed subset that would be an extra full read). The lowest integer is
+    kept free as the fill value.
     """
-    if os.path.exists(processed_file_path):
-        logging.info(f"Processed file already exists, skipping: {processed_file_path}")
-        return
+    dtype = np.dtype(pack.get('dtype', 'int16'))
+    info = np.iinfo(dtype)
+    valid_min = pack.get('valid_min')
+    valid_max = pack.get('valid_max')
+    if valid_min is None or valid_max is None:
+        if var.chunks:
+            raise ValueError(f"Packing '{var.name}' while streaming needs 'valid_min' and 'valid_max' in output_encoding")
+        valid_min = float(var.min(skipna=True)) if valid_min is None else valid_min
+        valid_max = float(var.max(skipna=True)) if valid_max is None else valid_max
+
+    steps = info.max - (info.min + 1)
+    scale_factor = (float(valid_max) - float(valid_min)) / steps or 1.0
+    add_offset = float(valid_min) - (info.min + 1) * scale_factor
+    return {
+        'dtype': dtype.name,
+        'scale_factor': scale_factor,
+        'add_offset': add_offset,
+        '_FillValue': info.min,
+        'missing_value': info.min
+    }, (float(valid_min), float(valid_max))
+
+def packing_without_range(output_encoding):
+    """Names of the 'output_encoding' blocks ('default' or a variable) that pack without a configured valid range"""
+    blocks = {'default': (output_encoding or {}).get('default') or {}}
+    blocks.update((output_encoding or {}).get('variables') or {})
+    return [
+        name for name, settings in blocks.items()
+        if (settings or {}).get('pack') and (settings['pack'].get('valid_min') is None or settings['pack'].get('valid_max') is None)
+    ]
+
+def apply_output_encoding(ds, output_encoding):
+    """
+    Builds the to_netcdf() encoding for a processed subset from the 'output_encoding'
+    config: zlib/shuffle compression for every data variable, plus chunk shapes,
+    float downcasting and optional integer packing for gridded (lat/lon) variables.
+    Per-variable settings are merged over the 'default' block.
+    Returns (ds, encoding); values outside a configured packing range are clipped
+    (in a copy, the caller's dataset is left as it is) so they cannot overflow
+    the integer type.
+    """
+    if not output_encoding:
+        return ds, {}
+
+    default = output_encoding.get('default', {}) or {}
+    overrides = output_encoding.get('variables', {}) or {}
+    encoding = {}
+    original = ds
+
+    for name in list(ds.data_vars):
+        var = ds[name]
+        settings = {**default, **(overrides.get(name) or {})}
+        var_encoding = {
+            'zlib': bool(settings.get('zlib', False)),
+            'complevel': settings.get('complevel', 4),
+            'shuffle': settings.get('shuffle', True)
+        }
+        # keep the source fill markers (e.g. CMIP6 1e20) unless the variable gets repacked
+        for key in ('_FillValue', 'missing_value'):
+            if key in var.encoding:
+                var_encoding[key] = var.encoding[key]
 
-    logging.info(f"Processing: {raw_file_path}")
+        if 'lat' in var.dims and 'lon' in var.dims:
+            chunks = settings.get('chunks')
+            if chunks and all(var.shape):
+                var_encoding['chunksizes'] = tuple(
+                    max(1, min(int(chunks.get(dim, size)), size)) for dim, size in zip(var.dims, var.shape)
+                )
+
+            is_float = np.issubdtype(var.dtype, np.floating)
+            if settings.get('pack') and is_float:
+                pack_encoding, (valid_min, valid_max) = _packing_encoding(var, settings['pack'])
+                var_encoding.update(pack_encoding)
+                if ds is original:
+                    ds = ds.copy()
+                ds[name] = var.clip(valid_min, valid_max, keep_attrs=True)
+            elif settings.get('dtype') and is_float:
+                var_encoding['dtype'] = settings['dtype']
+
+        encoding[name] = var_encoding
+
+    return ds, encoding
+
+def time_block_size(ds, memory_budget_mb):
+    """
+    Returns how many time steps of a raw file can be processed at once within the
+    memory budget. Sized on the full global field of every time-dependent variable,
+    so the bound holds even if a block ends up being read in full.
+    """
+    bytes_per_step = sum(
+        var.dtype.itemsize * int(np.prod([size for dim, size in zip(var.dims, var.shape) if dim != 'time']))
+        for var in ds.variables.values() if 'time' in var.dims
+    )
+    if not bytes_per_step:
+        return max(ds.sizes.get('time', 1), 1)
+    return max(1, int(memory_budget_mb * 1024**2 // (bytes_per_step * MEMORY_SAFETY_FACTOR)))
+
+def write_netcdf_outputs(outputs):
+    """
+    Writes (ds, encoding, path) outputs under temporary names and renames them once
+    all of them are written, so a failed write never leaves a file that a rerun
+    would treat as done. Dask-backed outputs are computed in a single pass, so
+    outputs derived from the same subset share the reads of each source block.
+    """
+    try:
+        if any(ds.chunks for ds, _, _ in outputs):
+            import dask
+            dask.compute(*[ds.to_netcdf(path + '.tmp', encoding=encoding, compute=False) for ds, encoding, path in outputs])
+        else:
+            for ds, encoding, path in outputs:
+                ds.to_netcdf(path + '.tmp', encoding=encoding)
+    except Exception:
+        for _, _, path in outputs:
+            if os.path.exists(path + '.tmp'):
+                os.remove(path + '.tmp')
+        raise
+    for _, _, path in outputs:
+        os.replace(path + '.tmp', path)
+
+def process_netcdf_file_regions(raw_file_path, region_jobs, index_cache=None, output_encoding=None,
+                                output_backend='netcdf', zarr_chunks=None, memory_budget_mb=None,
+                                skip_existing=True, temporal_aggregation=None):
+    """
+    Opens a raw NetCDF file once and writes one geographical subset per region.
+    'region_jobs' is a list of (processed_file_path, geo_scope) pairs. The file is
+    decoded a single time and each region is cut with positional indexes computed
+    from its lat/lon coordinates, instead of re-opening and re-indexing the file
+    for every region. If a GridIndexCache is given, those indexes are looked up
+    by grid signature instead of being recomputed. 'output_encoding' is the
+    config section controlling compression, chunking and packing of the outputs.
+
+    'output_backend' selects 'netcdf' (one file per time period), 'zarr' (the
+    period is appended to one consolidated store per variable/member, see
+    modules/zarr_store.py) or 'both'.
+
+    With 'memory_budget_mb' set, the file is streamed in time blocks sized to
+    stay within that budget: each block is read, subset and written before the
+    next one is touched (dask, synchronous scheduler), and the output is the
+    same as when the file is processed in one go.
+
+    NetCDF outputs that already exist are skipped unless 'skip_existing' is
+    False, i.e. the caller planned the jobs from the state manifest and an
+    existing file is a leftover that must be rewritten.
+
+    'temporal_aggregation' maps a source frequency to the aggregates written
+    next to each NetCDF subset (e.g. {'day': ['mon', 'clim']} writes
+    'tas_day-mon_...' and 'tas_day-clim_...', see modules/aggregation.py). They
+    are computed from the subset while it is being processed, so the regional
+    data is not read a second time to produce them.
+    Returns the processed paths that exist after the call.
+    """
+    write_netcdf = output_backend in ('netcdf', 'both')
+    write_zarr = output_backend in ('zarr', 'both')
+
+    done, pending = [], []
+    for processed_file_path, geo_scope in region_jobs:
+        needs_netcdf = write_netcdf and not (skip_existing and os.path.exists(processed_file_path))
+        needs_zarr = write_zarr and period_from_filename(processed_file_path) not in ingested_periods(zarr_store_path(processed_file_path))
+        if needs_netcdf or needs_zarr:
+            pending.append((processed_file_path, geo_scope, needs_netcdf, needs_zarr))
+        else:
+            logging.info(f"Processed output already exists, skipping: {processed_file_path}")
+            done.append(processed_file_path)
+
+    if not pending:
+        return done
+
+    logging.info(f"Processing: {raw_file_path} ({len(pending)} regions)")
     try:
         with xr.open_dataset(raw_file_path) as ds:
-            # using .sel() to select data within the latitude and longitude bounds
+            aggregate_products = (temporal_aggregation or {}).get(source_frequency(ds, raw_file_path)) or []
+            scheduler = nullcontext()
+            if memory_budget_mb and 'time' in ds.dims:
+                # dask is an optional dependency, only needed for streaming mode
+                import dask
+                block = time_block_size(ds, memory_budget_mb)
+                logging.info(f"Streaming {raw_file_path} in blocks of {block} time steps (budget {memory_budget_mb} MB)")
+                ds = ds.chunk({'time': block})
+                # one block in flight at a time keeps peak memory at a single block
+                scheduler = dask.config.set(scheduler='synchronous')
+
             # note: we assume the coordinate names are 'lat' and 'lon', might need
             # adjustment if the source files use different names (e.g., 'latitude')
-            subset = ds.sel(
-                lat=slice(geo_scope['min_lat'], geo_scope['max_lat']),
-                lon=slice(geo_scope['min_lon'], geo_scope['max_lon'])
-            )
-            
-            # saving the subsetted data to a new NetCDF file
-            subset.to_netcdf(processed_file_path)
-            logging.info(f"Successfully processed and saved to: {processed_file_path}")
+            with scheduler:
+                for processed_file_path, geo_scope, needs_netcdf, needs_zarr in pending:
+                    try:
+                        subset = subset_region(ds, geo_scope, index_cache)
+
+                        aggregates = {}
+                        if aggregate_products:
+                            if not subset.chunks:
+                                # the regional subset is small: read it once and aggregate it in memory
+                                subset = subset.load()
+                            aggregates = temporal_aggregates(subset, aggregate_products)
+
+                        outputs = [(subset, processed_file_path)] if needs_netcdf else []
+                        outputs += [(aggregate, aggregate_output_path(processed_file_path, product)) for product, aggregate in aggregates.items()]
+                        if outputs:
+                            outputs = [apply_output_encoding(output, output_encoding) + (path,) for output, path in outputs]
+                            write_netcdf_outputs(outputs)
+                            for _, _, path in outputs:
+                                logging.info(f"Successfully processed and saved to: {path}")
+
+                        if needs_zarr:
+                            append_to_zarr_store(
+                                subset, zarr_store_path(processed_file_path),
+                                period_from_filename(processed_file_path), zarr_chunks
+                            )
+
+                        done.append(processed_file_path)
+                    except Exception as e:
+                        logging.error(f"Could not write {processed_file_path} from {raw_file_path}. Error: {e}")
 
     except FileNotFoundError:
         logging.error(f"Raw file not found for processing: {raw_file_path}")
@@ -33,6 +238,18 @@ def process_netcdf_file(raw_file_path, processed_file_path, geo_scope):
     except Exception as e:
         logging.error(f"An unexpected error occurred while processing {raw_file_path}. Error: {e}")
 
+    return done
+
+def process_netcdf_file(raw_file_path, processed_file_path, geo_scope, index_cache=None, output_encoding=None,
+                        memory_budget_mb=None, temporal_aggregation=None):
+    """
+    Opens a raw NetCDF file, subsets it to the specified geographical scope and saves the result to a new file.
+    """
+    process_netcdf_file_regions(
+        raw_file_path, [(processed_file_path, geo_scope)], index_cache, output_encoding,
+        memory_budget_mb=memory_budget_mb, temporal_aggregation=temporal_aggregation
+    )
+
 
 
 '''
@@ -0,0 +1,105 @@
+import os
+import sqlite3
+import logging
+import pandas as pd
+import xarray as xr
+from modules.ensemble import ENSEMBLE_LABEL
+
+# fields files can be selected by, in the order of the index
+QUERY_FIELDS = ('region', 'model', 'experiment', 'variable', 'frequency', 'member')
+
+
+def find_files(index_path, region=None, model=None, experiment=None, variable=None, frequency=None,
+               member=None, start=None, end=None, product=None):
+    """
+    Looks up processed files in the catalog query index (see modules/catalog.py)
+    instead of walking the mirror. Every field is optional; a field may also be a
+    list of accepted values. 'start'/'end' ('YYYY', 'YYYY-MM' or 'YYYY-MM-DD')
+    keep only files whose time range overlaps the window. Ensemble-summary
+    products (member 'ensemble') are only returned when asked for by 'member',
+    and temporal aggregates (e.g. 'tas_day-mon_...') only when asked for by
+    'product' ('day', 'mon' or 'clim'); by default only native files match.
+    Returns a list of dicts with the indexed fields of each file, in time order.
+    """
+    if not os.path.exists(index_path):
+        raise FileNotFoundError(f"Catalog index not found: {index_path}. Run 'python -m utils.generate_metadata' first.")
+
+    clauses, params = [], []
+    values = dict(zip(QUERY_FIELDS, (region, model, experiment, variable, frequency, member)))
+    if member is None:
+        clauses.append("member IS NOT ?")
+        params.append(ENSEMBLE_LABEL)
+    if product is None:
+        clauses.append("product IS NULL")
+    else:
+        values['product'] = product
+    for field, value in values.items():
+        if value is None:
+            continue
+        value = [value] if isinstance(value, str) else list(value)
+        clauses.append(f"{field} IN ({', '.join('?' * len(value))})")
+        params.extend(value)
+    # ISO timestamps compare as strings; a file ending before 'start' or starting after 'end' is skipped
+    if start is not None:
+        clauses.append("time_end >= ?")
+        params.append(str(start))
+    if end is not None:
+        clauses.append("time_start <= ?")
+        # '1850-02' must also match files starting later in February 1850
+        params.append(str(end) + '\uffff')
+
+    query = "SELECT * FROM files"
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    query += " ORDER BY member, time_start"
+
+    conn = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True)
+    try:
+        conn.row_factory = sqlite3.Row
+        return [dict(row) for row in conn.execute(query, params)]
+    except sqlite3.OperationalError as e:
+        raise RuntimeError(f"Catalog index {index_path} is out of date ({e}). Rebuild it with 'python -m utils.generate_metadata'.") from e
+    finally:
+        conn.close()
+
+
+def open_mirror_dataset(index_path, region, model, experiment, variable, frequency=None, member=None,
+                        start=None, end=None, chunks=None, product=None):
+    """
+    Returns one lazily concatenated dataset for a region/model/experiment/variable.
+
+    Only the files overlapping [start, end] are opened (headers only, data stays
+    on disk as dask arrays) and the result is cut to that window. When several
+    members match, they are stacked along a new 'member' dimension. 'chunks' is
+    passed to xarray (default: one chunk per file). 'product' selects a temporal
+    aggregate instead of the native files, as in find_files().
+    """
+    files = find_files(index_path, region, model, experiment, variable, frequency, member, start, end, product)
+    if not files:
+        raise ValueError(
+            f"No processed files match region={region}, model={model}, experiment={experiment}, "
+            f"variable={variable}, frequency={frequency}, member={member}, time={start}..{end}."
+        )
+
+    frequencies = {f['frequency'] for f in files}
+    if len(frequencies) > 1:
+        raise ValueError(f"Files of several frequencies match ({sorted(frequencies)}); pass 'frequency' to choose one.")
+
+    by_member = {}
+    for f in files:
+        by_member.setdefault(f['member'], []).append(f['path'])
+    logging.info(f"Opening {len(files)} files for {variable} ({region}, {model}, {experiment}, {len(by_member)} members).")
+
+    datasets = []
+    for paths in by_member.values():
+        ds = xr.open_mfdataset(
+            paths, combine='nested', concat_dim='time', chunks=chunks or {},
+            data_vars='minimal', coords='minimal', compat='override', parallel=False
+        )
+        if start is not None or end is not None:
+            ds = ds.sel(time=slice(start, end))
+        datasets.append(ds)
+
+    if len(datasets) == 1:
+        return datasets[0]
+    return xr.concat(datasets, dim=pd.Index(list(by_member), name='member'), coords='minimal', compat='override')
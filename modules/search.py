@@ -1,67 +1,236 @@
+import os
+import json
+import time
+import hashlib
 import requests
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from modules.downloader import get_session
 
-# official ESGF search API endpoint
+# official ESGF search API endpoint (overridable from config.yaml 'search_settings')
 ESGF_SEARCH_URL = "https://esgf-node.llnl.gov/esg-search/search/"
 
-def find_download_urls(model, experiment, variable, ensemble_member):
+# --- default search settings ---
+DEFAULT_PAGE_SIZE = 500           # documents requested per page
+DEFAULT_SEARCH_WORKERS = 8        # faceted queries issued in parallel
+DEFAULT_SEARCH_TTL_HOURS = 24     # cached responses are reused for a day
+
+def _first(value):
+    """ESGF returns most document fields as single-element lists; unwraps them"""
+    if isinstance(value, list):
+        return value[0] if value else None
+    return value
+
+# --- on-disk response cache ---
+def _response_cache_path(cache_dir, search_url, params):
+    """One JSON file per distinct request, named after a hash of the URL and its parameters"""
+    key = json.dumps({'url': search_url, 'params': params}, sort_keys=True)
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+def _load_cached_response(cache_path, ttl_hours):
+    """Returns a cached response younger than 'ttl_hours', or None"""
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, 'r') as f:
+            cached = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read cached search response '{cache_path}', querying again. Reason: {e}")
+        return None
+    if time.time() - cached['fetched'] > ttl_hours * 3600:
+        return None
+    return cached['data']
+
+def _save_cached_response(cache_path, data):
+    """Writes a response atomically (unique temporary name, searches run in parallel)"""
+    tmp_path = f"{cache_path}.{os.getpid()}.{id(data)}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'fetched': time.time(), 'data': data}, f)
+    os.replace(tmp_path, cache_path)
+
+def search_page(params, offset, limit, search_url=ESGF_SEARCH_URL, cache_dir=None,
+                ttl_hours=DEFAULT_SEARCH_TTL_HOURS, session=None):
+    """
+    Fetches one page of search results as decoded JSON. Responses are cached in
+    'cache_dir' and reused until they are older than 'ttl_hours'.
+    Raises requests.RequestException if the node cannot be queried.
+    """
+    params = dict(params, offset=offset, limit=limit)
+    cache_path = None
+    if cache_dir:
+        cache_path = _response_cache_path(cache_dir, search_url, params)
+        data = _load_cached_response(cache_path, ttl_hours)
+        if data is not None:
+            return data
+
+    if session is None:
+        session = get_session()
+    # search nodes are plain HTTPS endpoints, so certificates are verified here
+    response = session.get(search_url, params=params, timeout=60, verify=True)
+    response.raise_for_status()
+    data = response.json()
+
+    if cache_path:
+        _save_cached_response(cache_path, data)
+    return data
+
+def search_all(params, search_url=ESGF_SEARCH_URL, page_size=DEFAULT_PAGE_SIZE, cache_dir=None,
+               ttl_hours=DEFAULT_SEARCH_TTL_HOURS, session=None):
+    """
+    Pages through every result of a query ('numFound' may be far above one page,
+    e.g. daily data split into many time chunks) and returns all documents.
+    """
+    docs = []
+    offset = 0
+    while True:
+        data = search_page(params, offset, page_size, search_url, cache_dir, ttl_hours, session)
+        page = data['response']['docs']
+        docs.extend(page)
+        offset += len(page)
+        if not page or offset >= data['response']['numFound']:
+            return docs
+
+def _download_entries(docs):
+    """
+    Extracts the downloadable files of search documents, preferring HTTPServer
+    links and falling back to Globus HTTPS links. Returns (files, available_services)
+    where each file is a dict with its 'url', 'checksum', 'checksum_type', 'size'
+    and 'variable'.
+    """
+    http_files = []
+    globus_files = []
+    available_services = set()
+
+    for doc in docs:
+        checksum = _first(doc.get('checksum'))
+        checksum_type = _first(doc.get('checksum_type'))
+        size = _first(doc.get('size'))
+
+        for url_entry in doc.get('url', []):
+            try:
+                url, mime_type, service_name = url_entry.split('|')
+                available_services.add(service_name)
+                file_info = {
+                    'url': url,
+                    'checksum': checksum,
+                    'checksum_type': checksum_type.lower() if checksum_type else None,
+                    'size': int(size) if size is not None else None,
+                    'variable': _first(doc.get('variable_id'))
+                }
+
+                if service_name == 'HTTPServer' and url.endswith('.nc'):
+                    http_files.append(file_info)
+                # check for globus URLs that are simple HTTPS links
+                elif service_name == 'Globus' and url.startswith('https') and url.endswith('.nc'):
+                    globus_files.append(file_info)
+            except ValueError:
+                logging.warning(f"Could not parse URL entry: {url_entry}")
+                continue
+
+    # --- Prioritise the best available URLs ---
+    return (http_files or globus_files), available_services
+
+def find_download_files(model, experiment, variable, ensemble_member, search_url=ESGF_SEARCH_URL, cache_dir=None,
+                        ttl_hours=DEFAULT_SEARCH_TTL_HOURS):
     """
     Searches the ESGF API to find direct download URLs for a given dataset.
     It prioritises standard HTTPServer links but will also find and use
     Globus web server links, which are also downloadable via HTTPS.
-    Returns a list of valid URLs.
+    Returns a list of dicts with the 'url' of each file plus the 'checksum',
+    'checksum_type' and 'size' published in its search document.
     """
     search_params = {
+        'type': 'File',  # file-level documents carry the per-file checksum and size
         'source_id': model,
         'experiment_id': experiment,
         'variable_id': variable,
         'member_id': ensemble_member,
         'distrib': 'true',
-        'format': 'application/solr+json',
-        'limit': 50
+        'format': 'application/solr+json'
     }
 
     logging.info(f"Searching for URLs for: {variable} ({ensemble_member})")
     try:
-        response = requests.get(ESGF_SEARCH_URL, params=search_params, timeout=30)
-        response.raise_for_status()
-        data = response.json()
-
-        if data['response']['numFound'] == 0:
-            logging.warning(f"No files found via API search for {variable} ({ensemble_member}). It may not be available.")
-            return []
-
-        # --- Extract URLs ---
-        http_urls = []
-        globus_urls = []
-        available_services = set()
-
-        for doc in data['response']['docs']:
-            for url_entry in doc.get('url', []):
-                try:
-                    url, mime_type, service_name = url_entry.split('|')
-                    available_services.add(service_name)
-                    
-                    if service_name == 'HTTPServer' and url.endswith('.nc'):
-                        http_urls.append(url)
-                    # check for globus URLs that are simple HTTPS links
-                    elif service_name == 'Globus' and url.startswith('https') and url.endswith('.nc'):
-                        globus_urls.append(url)
-                except ValueError:
-                    logging.warning(f"Could not parse URL entry: {url_entry}")
-                    continue
-
-        # --- Prioritise and return the best available URLs ---
-        if http_urls:
-            logging.info(f"Found {len(http_urls)} HTTPServer URLs for {variable} ({ensemble_member}).")
-            return http_urls
-        elif globus_urls:
-            logging.info(f"Found {len(globus_urls)} Globus HTTPS URLs for {variable} ({ensemble_member}). Using these.")
-            return globus_urls
-        else:
-            logging.warning(f"Found dataset for {variable} ({ensemble_member}), but no compatible download URL was found. Available services: {list(available_services)}")
-            return []
-
-    except requests.RequestException as e:
+        docs = search_all(search_params, search_url, cache_dir=cache_dir, ttl_hours=ttl_hours)
+    except (requests.RequestException, ValueError, KeyError) as e:
         logging.error(f"API search failed for {variable} ({ensemble_member}). Error: {e}")
-        return []
\ No newline at end of file
+        return []
+
+    if not docs:
+        logging.warning(f"No files found via API search for {variable} ({ensemble_member}). It may not be available.")
+        return []
+
+    files, available_services = _download_entries(docs)
+    if files:
+        logging.info(f"Found {len(files)} download URLs for {variable} ({ensemble_member}).")
+    else:
+        logging.warning(f"Found dataset for {variable} ({ensemble_member}), but no compatible download URL was found. Available services: {list(available_services)}")
+    return files
+
+def find_download_urls(model, experiment, variable, ensemble_member):
+    """
+    Searches the ESGF API to find direct download URLs for a given dataset.
+    Returns a list of valid URLs.
+    """
+    return [f['url'] for f in find_download_files(model, experiment, variable, ensemble_member)]
+
+def checksums_by_url(files):
+    """Maps each URL from find_download_files() to its (checksum, checksum_type) for the downloader"""
+    return {
+        f['url']: (f['checksum'], f['checksum_type'])
+        for f in files
+        if f.get('checksum') and f.get('checksum_type')
+    }
+
+def plan_search_files(dataset, group, search_url=ESGF_SEARCH_URL, cache_dir=None, ttl_hours=DEFAULT_SEARCH_TTL_HOURS,
+                      page_size=DEFAULT_PAGE_SIZE, max_workers=DEFAULT_SEARCH_WORKERS):
+    """
+    Builds the exact file list of a dataset's configuration group from the search
+    index, instead of guessing URLs from its 'url_template'.
+
+    One faceted query per variable is issued in parallel (members, MIP tables and
+    grids are OR-ed within a query), each paged through to the end. Only the
+    latest version of each file is kept; replicas on other data nodes are kept
+    as alternative URLs of the same file. Returns (files, failed_variables):
+    file dicts as find_download_files() returns them, plus the 'variable' of
+    each file, and the variables whose search failed (node down, bad response),
+    so the caller can fall back to guessing their URLs.
+    """
+    base_params = {
+        'type': 'File',
+        'source_id': dataset['source_id'],
+        'experiment_id': dataset['experiment'],
+        'member_id': dataset.get('ensemble_members', []),
+        'table_id': group.get('mip_tables', []),
+        'grid_label': dataset.get('grids_to_try', []),
+        'latest': 'true',
+        'distrib': 'true',
+        'format': 'application/solr+json'
+    }
+
+    def _worker(variable):
+        params = dict(base_params, variable_id=variable)
+        return search_all(params, search_url, page_size, cache_dir, ttl_hours, get_session(max_workers))
+
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    files, failed_variables = [], []
+    variables = group.get('variables') or []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_worker, variable): variable for variable in variables}
+        for future in as_completed(futures):
+            variable = futures[future]
+            try:
+                docs = future.result()
+            except (requests.RequestException, ValueError, KeyError) as e:
+                logging.error(f"API search failed for {dataset['name']} {variable}. Error: {e}")
+                failed_variables.append(variable)
+                continue
+            variable_files, available_services = _download_entries(docs)
+            if docs and not variable_files:
+                logging.warning(f"Found files for {dataset['name']} {variable}, but no compatible download URL. Available services: {list(available_services)}")
+            files.extend(variable_files)
+
+    logging.info(f"Search planned {len({f['url'].split('/')[-1] for f in files})} files ({len(files)} URLs incl. replicas) for {dataset['name']} / {group['name']}.")
+    return files, failed_variables
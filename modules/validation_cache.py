@@ -0,0 +1,76 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import logging
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS validation_results (
+    path TEXT PRIMARY KEY,
+    identity TEXT NOT NULL,
+    rules_signature TEXT NOT NULL,
+    result TEXT NOT NULL,
+    validated_at REAL NOT NULL
+);
+"""
+
+
+def file_identity(path, checksum=None):
+    """
+    Identity of a file as 'size:mtime_ns:checksum' (None if it cannot be stat'ed).
+    A file whose identity is unchanged since its last validation gives the same result
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return f"{st.st_size}:{st.st_mtime_ns}:{checksum or ''}"
+
+
+def rules_signature(validation_rules, variable):
+    """
+    Fingerprints the validation rules that apply to one variable: its own range
+    (or the default one) plus every rule that is not per-variable. Editing the
+    range of 'mrso' therefore only invalidates the cached results of mrso files.
+    """
+    variable_ranges = validation_rules.get('variable_ranges', {})
+    rules = {key: value for key, value in validation_rules.items() if key != 'variable_ranges'}
+    rules['variable_range'] = variable_ranges.get(variable, variable_ranges.get('default'))
+    payload = json.dumps(rules, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()[:16]
+
+
+class ValidationCache:
+    """
+    SQLite store of the last validation result of every file, keyed on the file's
+    identity (size, mtime, checksum) and the signature of the validation rules
+    it was checked against. A result is only reused while both still match.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, timeout=60)
+        with self._conn:
+            self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def load(self):
+        """Returns {path: (identity, rules_signature, result)} for every cached file, in one query"""
+        rows = self._conn.execute("SELECT path, identity, rules_signature, result FROM validation_results").fetchall()
+        return {path: (identity, signature, json.loads(result)) for path, identity, signature, result in rows}
+
+    def store(self, entries):
+        """Stores (path, identity, rules_signature, result) tuples"""
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO validation_results VALUES (?, ?, ?, ?, ?)",
+                [(path, identity, signature, json.dumps(result), now) for path, identity, signature, result in entries]
+            )
+        logging.info(f"Stored {len(entries)} validation results in {self.db_path}")
@@ -1,7 +1,204 @@
 import os
+import time
 import xarray as xr
 import numpy as np
 import logging
+from modules.grid_index import subset_region
+
+# --- default range check settings (overridable from config.yaml 'validation_rules.range_check') ---
+DEFAULT_RANGE_MEMORY_MB = 256  # memory for one block of time steps
+DEFAULT_HISTOGRAM_BINS = 20    # equal-width bins between valid_min and valid_max
+
+# --- structured results ---
+# every check returns a dict {'check', 'passed', 'message', 'details'}; 'passed' is
+# None when the check could not be performed (e.g. the variable is missing)
+
+def _result(check, passed, message, **details):
+    """Builds a check result and logs it with the usual [PASS]/[FAIL] prefix"""
+    if passed:
+        logging.info(f"  [PASS] {message}")
+    else:
+        logging.error(f"  [FAIL] {message}")
+    return {'check': check, 'passed': passed, 'message': message, 'details': details}
+
+# --- checks against an open dataset ---
+
+def check_time_coverage(ds, expected_start, expected_end):
+    """Checks if the dataset's time dimension covers the expected year range"""
+    try:
+        start_year = ds.time.dt.year.min().item()
+        end_year = ds.time.dt.year.max().item()
+    except Exception as e:
+        return _result('time_coverage', None, f"Time Coverage UNKNOWN: Could not read time dimension. Reason: {e}")
+    # checking if the file contains data within the expected range
+    if start_year <= expected_start and end_year >= expected_end:
+        return _result('time_coverage', True, f"Time Coverage OK: Found {start_year}-{end_year}.",
+                       start_year=start_year, end_year=end_year)
+    return _result('time_coverage', False,
+                   f"Time Coverage INCOMPLETE: Found {start_year}-{end_year}, expected {expected_start}-{expected_end}.",
+                   start_year=start_year, end_year=end_year)
+
+def _range_block_size(da, memory_budget_mb):
+    """Number of time steps of a variable that fit the memory budget once decoded to float64"""
+    n_time = da.sizes['time']
+    step_bytes = max(da.size // max(n_time, 1), 1) * 8
+    # decoding (scale/offset, fill values) and the NaN mask need a few copies of a block
+    return max(1, int(memory_budget_mb * 1024**2 // (step_bytes * 3)))
+
+def variable_stats(da, hist_range=None, bins=DEFAULT_HISTOGRAM_BINS, memory_budget_mb=DEFAULT_RANGE_MEMORY_MB):
+    """
+    Streams a variable block by block along 'time' and reduces every value:
+    returns {'min', 'max', 'count', 'nan_count', 'below', 'above', 'histogram'}.
+
+    Only one block of time steps is held in memory at a time, so memory stays
+    bounded and runtime grows linearly with the file size. The histogram uses
+    'bins' equal-width bins over 'hist_range' (valid_min, valid_max); values
+    outside it are counted in 'below'/'above'.
+    """
+    if 'time' in da.dims:
+        block = _range_block_size(da, memory_budget_mb)
+        blocks = (da.isel(time=slice(start, start + block)) for start in range(0, da.sizes['time'], block))
+    else:
+        blocks = [da]
+
+    stats = {'min': None, 'max': None, 'count': 0, 'nan_count': 0, 'below': 0, 'above': 0, 'histogram': None}
+    counts = np.zeros(bins, dtype='int64') if hist_range else None
+    for block_da in blocks:
+        values = np.asarray(block_da.values, dtype='float64').ravel()
+        finite = values[~np.isnan(values)]
+        stats['nan_count'] += values.size - finite.size
+        stats['count'] += finite.size
+        if not finite.size:
+            continue
+        block_min, block_max = finite.min(), finite.max()
+        stats['min'] = block_min if stats['min'] is None else min(stats['min'], block_min)
+        stats['max'] = block_max if stats['max'] is None else max(stats['max'], block_max)
+        if hist_range:
+            stats['below'] += int(np.count_nonzero(finite < hist_range[0]))
+            stats['above'] += int(np.count_nonzero(finite > hist_range[1]))
+            counts += np.histogram(finite, bins=bins, range=hist_range)[0]
+
+    if stats['min'] is not None:
+        stats['min'], stats['max'] = float(stats['min']), float(stats['max'])
+    if hist_range:
+        stats['histogram'] = {
+            'edges': np.linspace(hist_range[0], hist_range[1], bins + 1).tolist(),
+            'counts': counts.tolist()
+        }
+    return stats
+
+def check_data_range(ds, variable_id, valid_min, valid_max, memory_budget_mb=DEFAULT_RANGE_MEMORY_MB,
+                     bins=DEFAULT_HISTOGRAM_BINS):
+    """
+    Checks that every value of a variable, across all time steps, is within a
+    plausible range. The whole variable is streamed in time blocks (see
+    variable_stats) instead of sampling the first time steps.
+    """
+    try:
+        # explicitly convert min/max values to float to prevent type errors
+        valid_min = float(valid_min)
+        valid_max = float(valid_max)
+        stats = variable_stats(ds[variable_id], (valid_min, valid_max), bins, memory_budget_mb)
+    except Exception as e:
+        return _result('data_range', None, f"Data Range UNKNOWN: Could not perform check. Reason: {e}")
+    min_val, max_val = stats['min'], stats['max']
+    if min_val is None:
+        return _result('data_range', None, f"Data Range UNKNOWN: All {stats['nan_count']} values are missing.", **stats)
+    if min_val >= valid_min and max_val <= valid_max:
+        return _result('data_range', True,
+                       f"Data Range OK: Found min={min_val:.2f}, max={max_val:.2f} over {stats['count']} values ({stats['nan_count']} missing).",
+                       **stats)
+    return _result('data_range', False,
+                   f"Data Range UNREALISTIC: Found min={min_val:.2f}, max={max_val:.2f}. Expected range [{valid_min}, {valid_max}]; "
+                   f"{stats['below']} values below and {stats['above']} above.",
+                   **stats)
+
+def check_processing_consistency(raw_ds, processed_ds, geo_scope, variable_id, index_cache=None):
+    """Checks that the processed dataset is a true subset of the (already open) raw dataset"""
+    try:
+        # positional slices, shared with the processor through the grid index cache
+        raw_subset = subset_region(raw_ds, geo_scope, index_cache)
+        raw_mean = raw_subset[variable_id].mean().item()
+        processed_mean = processed_ds[variable_id].mean().item()
+    except Exception as e:
+        return _result('processing_consistency', None, f"Processing Consistency UNKNOWN: Could not perform check. Reason: {e}")
+    if np.isclose(raw_mean, processed_mean):
+        return _result('processing_consistency', True, f"Processing Consistency OK: Means match ({raw_mean:.4f}).",
+                       raw_mean=raw_mean, processed_mean=processed_mean)
+    return _result('processing_consistency', False,
+                   f"Processing Consistency MISMATCH: Raw mean={raw_mean:.4f}, Processed mean={processed_mean:.4f}.",
+                   raw_mean=raw_mean, processed_mean=processed_mean)
+
+# --- single-pass validation ---
+
+def _format_failure(file_path, e):
+    return _result('format', False, f"Format CORRUPT: {os.path.basename(file_path)}. Reason: {e}")
+
+def _summary(file_path, checks, started):
+    """A file passes when no check failed or could not be performed; 'seconds' is the time spent on it"""
+    return {
+        'file': file_path, 'passed': all(c['passed'] for c in checks), 'checks': checks,
+        'seconds': round(time.perf_counter() - started, 3)
+    }
+
+def validate_file(raw_file_path, variable_id, expected_start=None, expected_end=None, valid_range=None,
+                  processed_files=None, index_cache=None, memory_budget_mb=DEFAULT_RANGE_MEMORY_MB,
+                  histogram_bins=DEFAULT_HISTOGRAM_BINS, check_raw=True):
+    """
+    Validates a raw file and the processed files cut from it in a single pass.
+
+    The raw file is opened once and the format, time coverage and data range
+    checks all run against that open dataset. 'processed_files' is a list of
+    (processed_file_path, geo_scope) pairs; each processed file is opened once
+    and compared with the region subset of the same open raw dataset.
+    Checks whose inputs are not given (e.g. no 'valid_range') are skipped.
+    The range check covers every time step, streamed within 'memory_budget_mb'.
+    With 'check_raw' False only the processed files are checked (the raw file is
+    still opened for the consistency check) and 'raw' is None in the result.
+
+    Returns {'raw': summary, 'processed': [summary, ...]} where each summary is
+    {'file', 'passed', 'checks': [result, ...], 'seconds'}.
+    """
+    processed_files = processed_files or []
+    report = {'raw': None, 'processed': []}
+    started = time.perf_counter()
+
+    logging.info(f"-> Validating Raw File: {os.path.basename(raw_file_path)}")
+    try:
+        raw_ds = xr.open_dataset(raw_file_path, engine="netcdf4")
+    except Exception as e:
+        report['raw'] = _summary(raw_file_path, [_format_failure(raw_file_path, e)], started)
+        return report
+
+    with raw_ds:
+        if check_raw:
+            checks = [_result('format', True, f"Format OK: {os.path.basename(raw_file_path)}")]
+            if expected_start is not None and expected_end is not None:
+                checks.append(check_time_coverage(raw_ds, expected_start, expected_end))
+            if valid_range:
+                checks.append(check_data_range(
+                    raw_ds, variable_id, valid_range['min'], valid_range['max'], memory_budget_mb, histogram_bins
+                ))
+            report['raw'] = _summary(raw_file_path, checks, started)
+
+        for processed_file_path, geo_scope in processed_files:
+            logging.info(f"-> Validating Processed File: {processed_file_path}")
+            started = time.perf_counter()
+            try:
+                processed_ds = xr.open_dataset(processed_file_path, engine="netcdf4")
+            except Exception as e:
+                report['processed'].append(_summary(processed_file_path, [_format_failure(processed_file_path, e)], started))
+                continue
+            with processed_ds:
+                checks = [
+                    _result('format', True, f"Format OK: {os.path.basename(processed_file_path)}"),
+                    check_processing_consistency(raw_ds, processed_ds, geo_scope, variable_id, index_cache)
+                ]
+            report['processed'].append(_summary(processed_file_path, checks, started))
+
+    return report
+
+# --- single-check helpers (each opens the file itself) ---
 
 def validate_netcdf_format(file_path):
     """Checks if a file is a valid and readable NetCDF file"""
@@ -18,15 +215,7 @@ def validate_time_coverage(file_path, expected_start, expected_end):
     """Checks if the file's time dimension covers the expected year range"""
     try:
         with xr.open_dataset(file_path) as ds:
-            start_year = ds.time.dt.year.min().item()
-            end_year = ds.time.dt.year.max().item()
-            # checking if the file contains data within the expected range
-            if start_year <= expected_start and end_year >= expected_end:
-                logging.info(f"  [PASS] Time Coverage OK: Found {start_year}-{end_year}.")
-                return True
-            else:
-                logging.error(f"  [FAIL] Time Coverage INCOMPLETE: Found {start_year}-{end_year}, expected {expected_start}-{expected_end}.")
-                return False
+            return bool(check_time_coverage(ds, expected_start, expected_end)['passed'])
     except Exception as e:
         logging.error(f"  [FAIL] Time Coverage UNKNOWN: Could not read time dimension. Reason: {e}")
         return False
@@ -34,41 +223,17 @@ def validate_time_coverage(file_path, expected_start, expected_end):
 def validate_data_range(file_path, variable_id, valid_min, valid_max):
     """Checks if the data values for a variable are within a plausible range"""
     try:
-        # explicitly convert min/max values to float to prevent type errors
-        valid_min = float(valid_min)
-        valid_max = float(valid_max)
-
         with xr.open_dataset(file_path) as ds:
-            sample_data = ds[variable_id].isel(time=slice(0, 10)).values
-            min_val = np.nanmin(sample_data)
-            max_val = np.nanmax(sample_data)
-            if min_val >= valid_min and max_val <= valid_max:
-                logging.info(f"  [PASS] Data Range OK: Found min={min_val:.2f}, max={max_val:.2f}.")
-                return True
-            else:
-                logging.error(f"  [FAIL] Data Range UNREALISTIC: Found min={min_val:.2f}, max={max_val:.2f}. Expected range [{valid_min}, {valid_max}].")
-                return False
+            return bool(check_data_range(ds, variable_id, valid_min, valid_max)['passed'])
     except Exception as e:
         logging.error(f"  [FAIL] Data Range UNKNOWN: Could not perform check. Reason: {e}")
         return False
 
-def validate_processing_consistency(raw_file_path, processed_file_path, geo_scope, variable_id):
+def validate_processing_consistency(raw_file_path, processed_file_path, geo_scope, variable_id, index_cache=None):
     """Checks that the processed file is a true subset of the raw file"""
     try:
         with xr.open_dataset(raw_file_path) as raw_ds, xr.open_dataset(processed_file_path) as processed_ds:
-            raw_subset = raw_ds.sel(
-                lat=slice(geo_scope['min_lat'], geo_scope['max_lat']),
-                lon=slice(geo_scope['min_lon'], geo_scope['max_lon'])
-            )
-            raw_mean = raw_subset[variable_id].mean().item()
-            processed_mean = processed_ds[variable_id].mean().item()
-
-            if np.isclose(raw_mean, processed_mean):
-                logging.info(f"  [PASS] Processing Consistency OK: Means match ({raw_mean:.4f}).")
-                return True
-            else:
-                logging.error(f"  [FAIL] Processing Consistency MISMATCH: Raw mean={raw_mean:.4f}, Processed mean={processed_mean:.4f}.")
-                return False
+            return bool(check_processing_consistency(raw_ds, processed_ds, geo_scope, variable_id, index_cache)['passed'])
     except Exception as e:
         logging.error(f"  [FAIL] Processing Consistency UNKNOWN: Could not perform check. Reason: {e}")
-        return False
\ No newline at end of file
+        return False
@@ -0,0 +1,147 @@
+import os
+import fcntl
+import shutil
+import logging
+import numpy as np
+import xarray as xr
+from contextlib import contextmanager
+
+# store attribute listing the time_period strings already appended to a store
+INGESTED_PERIODS_ATTR = 'ingested_periods'
+
+# default time-major chunking: long time axis, small spatial tiles
+DEFAULT_ZARR_CHUNKS = {'time': 3650, 'lat': 16, 'lon': 16}
+
+
+def period_from_filename(file_path):
+    """Extracts the time_period string (e.g. '18500101-18691231') from a CMIP6 filename"""
+    return os.path.basename(file_path)[:-len('.nc')].rsplit('_', 1)[1]
+
+
+def zarr_store_path(processed_file_path):
+    """
+    Maps a per-period processed file path to its consolidated Zarr store, i.e. one
+    store per region/model/experiment/variable/table/member/grid:
+    '.../mrso_day_GFDL-ESM4_historical_r1i1p1f1_gr1_18500101-18691231.nc'
+    -> '.../mrso_day_GFDL-ESM4_historical_r1i1p1f1_gr1.zarr'
+    """
+    directory, file_name = os.path.split(processed_file_path)
+    return os.path.join(directory, file_name[:-len('.nc')].rsplit('_', 1)[0] + '.zarr')
+
+
+def ingested_periods(store_path):
+    """Returns the set of time periods already appended to a store (empty if it does not exist)"""
+    if not os.path.exists(store_path):
+        return set()
+    try:
+        with xr.open_dataset(store_path, engine='zarr', chunks=None) as ds:
+            return set(ds.attrs.get(INGESTED_PERIODS_ATTR, []))
+    except Exception as e:
+        logging.warning(f"Could not read ingested periods from {store_path}. Reason: {e}")
+        return set()
+
+
+@contextmanager
+def _store_lock(store_path):
+    """Serialises writers to the same store across threads and processes"""
+    with open(store_path + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _zarr_encoding(ds, chunks):
+    """
+    Time-major chunk encoding for every time-dependent variable of a new store.
+    The time chunk is not clipped to the first period's length, so later appends
+    keep filling full-size chunks.
+    """
+    encoding = {}
+    for name, var in ds.data_vars.items():
+        if 'time' in var.dims and all(var.shape):
+            encoding[name] = {
+                'chunks': tuple(
+                    int(chunks.get(dim, size)) if dim == 'time' else max(1, min(int(chunks.get(dim, size)), size))
+                    for dim, size in zip(var.dims, var.shape)
+                )
+            }
+    return encoding
+
+
+def _write_new_store(ds, store_path, chunks, periods):
+    """Writes a fresh store under a temporary name and swaps it into place"""
+    ds = ds.copy()
+    ds.attrs[INGESTED_PERIODS_ATTR] = sorted(periods)
+    # drop encodings inherited from the NetCDF source (chunksizes, zlib, ...) that do not apply to zarr
+    for var in ds.variables.values():
+        var.encoding = {key: value for key, value in var.encoding.items() if key in ('units', 'calendar', 'dtype', '_FillValue')}
+
+    tmp_path = store_path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    # safe_chunks=False: streamed (dask) blocks need not line up with zarr chunks, and
+    # the store lock guarantees a single writer, so partial chunks are written safely
+    ds.to_zarr(tmp_path, mode='w', encoding=_zarr_encoding(ds, chunks), consolidated=True, safe_chunks=False)
+
+    if os.path.exists(store_path):
+        old_path = store_path + '.old'
+        os.replace(store_path, old_path)
+        os.replace(tmp_path, store_path)
+        shutil.rmtree(old_path)
+    else:
+        os.replace(tmp_path, store_path)
+
+
+def append_to_zarr_store(subset, store_path, period, chunks=None):
+    """
+    Appends one processed time_period chunk to a consolidated Zarr store along 'time'.
+
+    The store records which periods it already holds, so reruns only add new
+    ones. Time steps already present (e.g. from an overlapping '201501-210012'
+    file) are dropped before appending. Chunks normally arrive in time order and
+    are appended in place; a chunk that belongs before the end of the store is
+    merged and the store rewritten in time order.
+    Returns True once the period is in the store.
+    """
+    # zarr is an optional dependency, only needed when the zarr backend is enabled
+    import zarr
+
+    chunks = chunks or DEFAULT_ZARR_CHUNKS
+
+    with _store_lock(store_path):
+        periods = ingested_periods(store_path)
+        if period in periods:
+            logging.info(f"Period {period} already in Zarr store, skipping: {store_path}")
+            return True
+
+        if not os.path.exists(store_path):
+            _write_new_store(subset, store_path, chunks, periods | {period})
+            logging.info(f"Created Zarr store with period {period}: {store_path}")
+            return True
+
+        with xr.open_dataset(store_path, engine='zarr', chunks=None) as existing:
+            existing_times = existing['time'].values
+            new_steps = ~np.isin(subset['time'].values, existing_times)
+            subset = subset.isel(time=new_steps)
+
+            if subset.sizes['time'] and subset['time'].values[0] <= existing_times[-1]:
+                # out-of-order chunk: merge in memory (regional data is small) and rewrite sorted
+                logging.warning(f"Period {period} precedes the end of {store_path}; rewriting the store in time order.")
+                merged = xr.concat([existing, subset], dim='time', data_vars='minimal', coords='minimal', compat='override')
+                merged = merged.sortby('time').load()
+                _write_new_store(merged, store_path, chunks, periods | {period})
+                return True
+
+        if subset.sizes['time']:
+            time_vars = [name for name, var in subset.variables.items() if 'time' in var.dims]
+            subset[time_vars].to_zarr(store_path, append_dim='time', consolidated=True, safe_chunks=False)
+
+        # record the period, then refresh the consolidated metadata so readers see it
+        group = zarr.open_group(store_path, mode='r+')
+        group.attrs[INGESTED_PERIODS_ATTR] = sorted(periods | {period})
+        zarr.consolidate_metadata(store_path)
+
+        logging.info(f"Appended period {period} to Zarr store: {store_path}")
+        return True
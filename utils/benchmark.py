@@ -0,0 +1,644 @@
+import os
+import sys
+import json
+import time
+import yaml
+import random
+import hashlib
+import shutil
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import functools
+import threading
+import subprocess
+import multiprocessing
+import http.server
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+import xarray as xr
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor
+from main import build_candidate_urls
+from modules.search import plan_search_files
+from modules.downloader import download_files, DEFAULT_MAX_WORKERS, DEFAULT_CHUNK_SIZE, DEFAULT_SEGMENTS, DEFAULT_SEGMENT_THRESHOLD
+from modules.hosts import HostScheduler
+from modules.metrics import MetricsRecorder
+from modules.processor import process_netcdf_file_regions
+from modules.grid_index import GridIndexCache
+from modules.validator import validate_file, DEFAULT_RANGE_MEMORY_MB, DEFAULT_HISTOGRAM_BINS
+
+# synthetic grids: (source_id, experiment, member, n_lat, n_lon). gr1 is the 1 degree
+# ESM4 grid; gr3 approximates the regridded SPEAR-MED atmosphere (1 x 1.25 degrees)
+GRIDS = {
+    'gr1': ('GFDL-ESM4', 'historical', 'r1i1p1f1', 180, 360),
+    'gr3': ('GFDL-SPEAR-MED', 'historical', 'r1i1p1f1', 180, 288)
+}
+
+# synthetic frequencies: (MIP table, pandas frequency, default time steps per file)
+FREQUENCIES = {
+    'mon': ('Amon', 'MS', 120),   # 10 years
+    'day': ('day', 'D', 365),     # 1 year
+    '3hr': ('3hr', '3h', 730)     # 3 months
+}
+
+BENCHMARK_VARIABLE = 'tas'
+FIXTURE_SEED = 42  # fixed, so every commit is measured on the same bytes
+SERVER_CHUNK_SIZE = 1024 * 1024
+
+# fault scenario (--faults): one stand-in per kind of data node, all serving the same fixtures.
+# 'error_rate' answers 503, 'drop_rate' cuts the connection halfway through the body,
+# 'delay_s' waits before answering and 'dead' answers every request with 503
+FAULT_PROFILES = {
+    'healthy': {},
+    'flaky': {'error_rate': 0.2, 'drop_rate': 0.2, 'delay_s': 0.05},
+    'dead': {'dead': True}
+}
+# the scenario shortens backoff and cooldown so it finishes in seconds
+FAULT_HOST_SETTINGS = {'backoff_base_s': 0.05, 'backoff_max_s': 1.0, 'cooldown_s': 60}
+
+# search scenario (--search): documents per page of the stand-in search node. Every file is
+# published twice (a replica under 'localhost'), so a page of one document exercises paging
+SEARCH_PAGE_SIZE = 1
+# search document fields the stand-in filters on (values within a field are OR-ed, like ESGF facets)
+SEARCH_FACETS = ('source_id', 'experiment_id', 'variable_id', 'table_id', 'member_id', 'grid_label')
+
+
+# --- synthetic fixtures ---
+
+def fixture_name(grid, frequency, steps):
+    """CMIP6-style file name of a synthetic fixture"""
+    source_id, experiment, member, _, _ = GRIDS[grid]
+    table, _, _ = FREQUENCIES[frequency]
+    times = xr.date_range('1850-01-01', periods=steps, freq=FREQUENCIES[frequency][1], calendar='noleap', use_cftime=True)
+    fmt = {'mon': '%Y%m', 'day': '%Y%m%d', '3hr': '%Y%m%d%H%M'}[frequency]
+    period = f"{times[0].strftime(fmt)}-{times[-1].strftime(fmt)}"
+    return f"{BENCHMARK_VARIABLE}_{table}_{source_id}_{experiment}_{member}_{grid}_{period}.nc"
+
+
+def make_fixture(path, grid, frequency, steps):
+    """
+    Writes a CMIP6-shaped NetCDF file: a smooth temperature field with a seasonal
+    cycle plus noise (so it compresses like real data), noleap time axis, bounds
+    variables, 1e20 fill value and deflate level 1 per-time-step chunks as in the
+    files published on ESGF.
+    """
+    source_id, experiment, member, n_lat, n_lon = GRIDS[grid]
+    table, freq, _ = FREQUENCIES[frequency]
+    rng = np.random.default_rng(FIXTURE_SEED)
+
+    lat = np.linspace(-90 + 90 / n_lat, 90 - 90 / n_lat, n_lat)
+    lon = np.linspace(180 / n_lon, 360 - 180 / n_lon, n_lon)
+    times = xr.date_range('1850-01-01', periods=steps, freq=freq, calendar='noleap', use_cftime=True)
+    day_of_year = np.array([t.dayofyr for t in times], dtype='float32')
+
+    climate = (300 - 45 * np.sin(np.deg2rad(lat)) ** 2).astype('float32')[:, None] * np.ones((1, n_lon), 'float32')
+    season = (10 * np.sin(2 * np.pi * day_of_year / 365))[:, None, None] * np.sign(lat)[None, :, None]
+    values = climate[None] + season.astype('float32') + rng.normal(0, 1.5, (steps, n_lat, n_lon)).astype('float32')
+
+    def bounds(centres):
+        half = np.diff(centres).mean() / 2
+        return np.stack([centres - half, centres + half], axis=1)
+
+    ds = xr.Dataset(
+        {
+            BENCHMARK_VARIABLE: (('time', 'lat', 'lon'), values, {
+                'standard_name': 'air_temperature', 'long_name': 'Near-Surface Air Temperature',
+                'units': 'K', 'cell_methods': 'area: time: mean'
+            }),
+            'lat_bnds': (('lat', 'bnds'), bounds(lat)),
+            'lon_bnds': (('lon', 'bnds'), bounds(lon)),
+        },
+        coords={
+            'time': times,
+            'lat': ('lat', lat, {'units': 'degrees_north', 'standard_name': 'latitude'}),
+            'lon': ('lon', lon, {'units': 'degrees_east', 'standard_name': 'longitude'})
+        },
+        attrs={
+            'source_id': source_id, 'experiment_id': experiment, 'variant_label': member, 'grid_label': grid,
+            'table_id': table, 'frequency': frequency, 'variable_id': BENCHMARK_VARIABLE,
+            'title': 'Synthetic benchmark fixture'
+        }
+    )
+    encoding = {
+        BENCHMARK_VARIABLE: {'zlib': True, 'complevel': 1, 'shuffle': True, '_FillValue': np.float32(1e20),
+                             'chunksizes': (1, n_lat, n_lon)},
+        'time': {'units': 'days since 1850-01-01', 'calendar': 'noleap', 'dtype': 'float64'}
+    }
+    tmp_path = path + '.tmp'
+    ds.to_netcdf(tmp_path, encoding=encoding)
+    os.replace(tmp_path, path)
+
+
+def ensure_fixtures(fixtures_dir, grids, frequencies, steps_scale=1.0):
+    """Creates the fixtures that do not exist yet. Returns [(grid, frequency, path)]"""
+    os.makedirs(fixtures_dir, exist_ok=True)
+    fixtures = []
+    for grid in grids:
+        for frequency in frequencies:
+            steps = max(2, int(FREQUENCIES[frequency][2] * steps_scale))
+            path = os.path.join(fixtures_dir, fixture_name(grid, frequency, steps))
+            if not os.path.exists(path):
+                logging.info(f"Generating fixture: {path}")
+                make_fixture(path, grid, frequency, steps)
+            fixtures.append((grid, frequency, path))
+    return fixtures
+
+
+# --- local HTTP stand-in for the data nodes ---
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Static file handler with keep-alive and single 'Range: bytes=' requests
+    (206/416 responses), which is what the downloader relies on from the ESGF
+    and S3 data nodes for resume and segmented downloads.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404, "File not found")
+            return None
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+
+        range_header = self.headers.get('Range', '')
+        if range_header.startswith('bytes='):
+            first, _, last = range_header[len('bytes='):].split(',')[0].strip().partition('-')
+            if first:
+                start, end = int(first), int(last) if last else size - 1
+            else:
+                start = max(0, size - int(last))
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', f"bytes */{size}")
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+            end = min(end, size - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Type', 'application/x-netcdf')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        f = open(path, 'rb')
+        f.seek(start)
+        self._remaining = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        remaining = self._remaining
+        while remaining > 0:
+            chunk = source.read(min(SERVER_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            remaining -= len(chunk)
+
+
+class FaultInjectingHandler(RangeRequestHandler):
+    """
+    RangeRequestHandler that misbehaves like an overloaded or failing data node,
+    following a fault profile (see FAULT_PROFILES). Faults are drawn from a
+    seeded generator, so a scenario fails the same way on every run.
+    """
+    faults = {}
+    rng = random.Random(FIXTURE_SEED)
+    rng_lock = threading.Lock()
+
+    def _draw(self, rate):
+        with self.rng_lock:
+            return self.rng.random() < rate
+
+    def send_head(self):
+        time.sleep(self.faults.get('delay_s', 0))
+        if self.faults.get('dead') or self._draw(self.faults.get('error_rate', 0)):
+            self.send_error(503, "Service Unavailable")
+            return None
+        self._drop = self.command == 'GET' and self._draw(self.faults.get('drop_rate', 0))
+        return super().send_head()
+
+    def copyfile(self, source, outputfile):
+        if self._drop:
+            # send half of the promised body, then close the connection
+            self._remaining //= 2
+            self.close_connection = True
+        super().copyfile(source, outputfile)
+
+
+class SearchRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Stand-in for an ESGF search node: answers 'type=File' queries in the
+    application/solr+json format with 'numFound' and one 'offset'/'limit' page
+    of the documents matching the facets. With 'broken' set it answers every
+    query with a body that is not JSON, like a node behind a failing proxy.
+    """
+    protocol_version = 'HTTP/1.1'
+    docs = []
+    broken = False
+    pages_served = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        params = parse_qs(urlsplit(self.path).query)
+        if self.broken:
+            body = b'<html>502 Bad Gateway</html>'
+        else:
+            matching = [
+                doc for doc in self.docs
+                if all(set(doc[facet]) & set(params[facet]) for facet in SEARCH_FACETS if facet in params)
+            ]
+            offset, limit = int(params.get('offset', ['0'])[0]), int(params.get('limit', ['10'])[0])
+            body = json.dumps({'response': {'numFound': len(matching), 'docs': matching[offset:offset + limit]}}).encode()
+            type(self).pages_served += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def search_documents(fixtures, base_url):
+    """
+    ESGF-style file documents for the fixtures served at base_url, with their
+    sha256 and size: one per replica, the second one on a 'localhost' URL
+    """
+    docs = []
+    replica_url = base_url.replace('127.0.0.1', 'localhost')
+    for (_, _, path), data_node in ((fixture, node) for fixture in fixtures for node in (base_url, replica_url)):
+        file_name = os.path.basename(path)
+        variable, table, source_id, experiment, member, grid, _ = file_name[:-len('.nc')].split('_')
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        docs.append({
+            'source_id': [source_id], 'experiment_id': [experiment], 'variable_id': [variable],
+            'table_id': [table], 'member_id': [member], 'grid_label': [grid],
+            'checksum': [digest], 'checksum_type': ['SHA256'], 'size': [os.path.getsize(path)],
+            'url': [f"{data_node}/{file_name}|application/netcdf|HTTPServer"]
+        })
+    return docs
+
+
+def serve_search(docs, broken=False):
+    """Serves a search stand-in over the given documents from a background thread. Returns (server, search_url)"""
+    handler_class = type('SearchNodeHandler', (SearchRequestHandler,), {'docs': docs, 'broken': broken})
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/esg-search/search/"
+
+
+def serve_directory(directory, faults=None):
+    """
+    Serves a directory on a free localhost port from a background thread,
+    optionally with a fault profile (see FaultInjectingHandler). Returns (server, base_url)
+    """
+    if faults:
+        handler_class = type('FaultProfileHandler', (FaultInjectingHandler,), {
+            'faults': faults, 'rng': random.Random(FIXTURE_SEED), 'rng_lock': threading.Lock()
+        })
+    else:
+        handler_class = RangeRequestHandler
+    handler = functools.partial(handler_class, directory=directory)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# --- stages, each run in a fresh process so its peak RSS can be measured ---
+
+def _download_stage(url, target_dir, settings):
+    results = list(download_files(
+        [url], target_dir, settings['max_workers'], settings['chunk_size'], settings['segments'],
+        settings['segment_threshold'], skip_existing=False
+    ))
+    if not results or not results[0][1]:
+        raise RuntimeError(f"Download failed: {url}")
+
+
+def _processing_stage(raw_file_path, region_jobs, processing_regions, settings):
+    done = process_netcdf_file_regions(
+        raw_file_path, region_jobs, GridIndexCache(None, processing_regions), settings['output_encoding'],
+        'netcdf', None, settings['memory_budget_mb'], False, settings['temporal_aggregation']
+    )
+    if len(done) != len(region_jobs):
+        raise RuntimeError(f"Processing wrote {len(done)} of {len(region_jobs)} regions for {raw_file_path}")
+
+
+def _validation_stage(raw_file_path, region_jobs, processing_regions, settings):
+    report = validate_file(
+        raw_file_path, BENCHMARK_VARIABLE, valid_range=settings['valid_range'], processed_files=region_jobs,
+        index_cache=GridIndexCache(None, processing_regions), memory_budget_mb=settings['memory_budget_mb'], histogram_bins=settings['histogram_bins']
+    )
+    if not report['raw']['passed'] or not all(summary['passed'] for summary in report['processed']):
+        raise RuntimeError(f"Validation of the benchmark outputs failed for {raw_file_path}")
+
+
+def peak_rss_mb():
+    """
+    Peak RSS of this process in MB. On Linux VmHWM is used: ru_maxrss survives
+    fork/exec, so a spawned worker would report its parent's peak.
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _measured(stage, args):
+    """Worker: runs a stage and returns (seconds, peak RSS MB, RSS MB before the stage)"""
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    baseline = peak_rss_mb()
+    started = time.perf_counter()
+    stage(*args)
+    seconds = time.perf_counter() - started
+    return seconds, peak_rss_mb(), baseline
+
+
+def run_stage(stage, *args):
+    """Runs a stage in a fresh 'spawn' process (clean peak RSS, cold imports paid before timing)"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(_measured, stage, args).result()
+
+
+def _result(seconds, peak_rss_mb, baseline_rss_mb, megabytes):
+    return {
+        'seconds': round(seconds, 3),
+        'mb_per_s': round(megabytes / seconds, 2) if seconds else None,
+        'peak_rss_mb': round(peak_rss_mb, 1),
+        'baseline_rss_mb': round(baseline_rss_mb, 1)
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(config, fixtures, work_dir, repeat=1):
+    """
+    Times download, multi-region processing and validation of every fixture with
+    the settings of the given config. Each repetition of each stage runs in its
+    own process; the fastest repetition is reported. Returns {'stage/grid/frequency': result}.
+    """
+    download_settings = config.get('download_settings', {})
+    processing_settings = config.get('processing_settings', {})
+    range_check = config.get('validation_rules', {}).get('range_check', {})
+    variable_ranges = config.get('validation_rules', {}).get('variable_ranges', {})
+    processing_regions = config.get('processing_regions', [])
+
+    settings = {
+        'max_workers': download_settings.get('max_workers', DEFAULT_MAX_WORKERS),
+        'chunk_size': int(download_settings.get('chunk_size_kb', DEFAULT_CHUNK_SIZE // 1024) * 1024),
+        'segments': download_settings.get('segments', DEFAULT_SEGMENTS),
+        'segment_threshold': int(download_settings.get('segment_threshold_mb', DEFAULT_SEGMENT_THRESHOLD // 1024**2) * 1024**2),
+        'output_encoding': config.get('output_encoding', {}),
+        'memory_budget_mb': processing_settings.get('memory_budget_mb'),
+        'temporal_aggregation': config.get('temporal_aggregation') or {},
+        'valid_range': variable_ranges.get(BENCHMARK_VARIABLE, variable_ranges.get('default')),
+        'range_memory_mb': range_check.get('memory_budget_mb', DEFAULT_RANGE_MEMORY_MB),
+        'histogram_bins': range_check.get('histogram_bins', DEFAULT_HISTOGRAM_BINS)
+    }
+    validation_settings = dict(settings, memory_budget_mb=settings['range_memory_mb'])
+
+    fixtures_dir = os.path.dirname(fixtures[0][2])
+    server, base_url = serve_directory(fixtures_dir)
+    results = {}
+    try:
+        for grid, frequency, fixture_path in fixtures:
+            file_name = os.path.basename(fixture_path)
+            megabytes = os.path.getsize(fixture_path) / 1024**2
+            raw_dir = os.path.join(work_dir, 'raw')
+            raw_file_path = os.path.join(raw_dir, file_name)
+            region_jobs = [
+                (os.path.join(work_dir, region['name'], file_name), region['bounding_box'])
+                for region in processing_regions
+            ]
+            for path, _ in region_jobs:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            stages = [
+                ('download', _download_stage, (f"{base_url}/{file_name}", raw_dir, settings)),
+                ('processing', _processing_stage, (raw_file_path, region_jobs, processing_regions, settings)),
+                ('validation', _validation_stage, (raw_file_path, region_jobs, processing_regions, validation_settings))
+            ]
+            for stage_name, stage, args in stages:
+                runs = []
+                for _ in range(repeat):
+                    if stage_name == 'download':
+                        shutil.rmtree(raw_dir, ignore_errors=True)
+                        os.makedirs(raw_dir)
+                    runs.append(run_stage(stage, *args))
+                seconds, peak, baseline = min(runs)
+                key = f"{stage_name}/{grid}/{frequency}"
+                results[key] = _result(seconds, peak, baseline, megabytes)
+                results[key]['file_mb'] = round(megabytes, 1)
+                logging.info(f"{key}: {results[key]['seconds']} s, {results[key]['mb_per_s']} MB/s, peak RSS {results[key]['peak_rss_mb']} MB")
+    finally:
+        server.shutdown()
+    return results
+
+
+def run_fault_scenario(config, fixtures, work_dir):
+    """
+    Downloads every fixture from one local stand-in per fault profile at the
+    same time, with the per-host policies of the config ('download_settings.hosts',
+    backoff shortened). Shows that flaky hosts recover through retries and that a
+    dead host trips its circuit breaker without holding up the others.
+    Returns {'faults/profile': result}.
+    """
+    download_settings = config.get('download_settings', {})
+    host_settings = dict(download_settings.get('hosts') or {})
+    host_settings['default'] = {**(host_settings.get('default') or {}), **FAULT_HOST_SETTINGS}
+    hosts = HostScheduler(host_settings)
+    recorder = MetricsRecorder(job='faults')
+    fixtures_dir = os.path.dirname(fixtures[0][2])
+
+    servers, urls, labels = [], [], {}
+    try:
+        for profile, faults in FAULT_PROFILES.items():
+            server, base_url = serve_directory(fixtures_dir, faults)
+            servers.append(server)
+            target_dir = os.path.join(work_dir, 'faults', profile)
+            os.makedirs(target_dir, exist_ok=True)
+            for _, _, fixture_path in fixtures:
+                url = f"{base_url}/{os.path.basename(fixture_path)}"
+                urls.append((url, target_dir))
+                labels[url] = {'dataset': profile}
+
+        started = time.perf_counter()
+        # one batch per target directory, drained concurrently so the hosts compete for the workers
+        batches = [
+            download_files(
+                [url for url, target in urls if target == target_dir], target_dir,
+                download_settings.get('max_workers', DEFAULT_MAX_WORKERS), skip_existing=False,
+                metrics=recorder, labels=labels, hosts=hosts
+            )
+            for target_dir in sorted({target for _, target in urls})
+        ]
+        threads = [threading.Thread(target=list, args=(batch,)) for batch in batches]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - started
+    finally:
+        for server in servers:
+            server.shutdown()
+
+    results = {}
+    for (stage, profile, _, _), totals in sorted(recorder.totals().items(), key=lambda item: str(item[0][1])):
+        results[f"faults/{profile}"] = {
+            'files': totals['count'],
+            'failed': totals['failed'],
+            'retries': totals['retries'],
+            'seconds': round(totals['max_seconds'], 3)
+        }
+        logging.info(
+            f"faults/{profile}: {totals['count'] - totals['failed']}/{totals['count']} files, "
+            f"{totals['retries']} retries, slowest file {totals['max_seconds']:.2f} s"
+        )
+    logging.info(f"Fault scenario finished in {seconds:.2f} s")
+    return results
+
+
+def run_search_scenario(fixtures, work_dir):
+    """
+    Plans and downloads the fixtures through a search stand-in paged
+    SEARCH_PAGE_SIZE documents at a time, then again with a broken search node,
+    where the variables whose search failed fall back to 'url_template' as the
+    pipeline does. Both runs must find every fixture. Returns {'search/run': result}.
+    """
+    fixtures_dir = os.path.dirname(fixtures[0][2])
+    file_server, base_url = serve_directory(fixtures_dir)
+    results = {}
+    try:
+        for run, broken in (('paged', False), ('fallback', True)):
+            search_server, search_url = serve_search(search_documents(fixtures, base_url), broken)
+            target_dir = os.path.join(work_dir, 'search', run)
+            os.makedirs(target_dir, exist_ok=True)
+            started = time.perf_counter()
+            downloaded = 0
+            try:
+                for grid in sorted({grid for grid, _, _ in fixtures}):
+                    names = [os.path.basename(path)[:-len('.nc')].split('_') for g, _, path in fixtures if g == grid]
+                    _, _, source_id, experiment, member, _, _ = names[0]
+                    dataset = {
+                        'name': f"benchmark_{grid}", 'source_id': source_id, 'experiment': experiment,
+                        'ensemble_members': [member], 'grids_to_try': [grid], 'versions_to_try': ['v0'],
+                        'url_template': f"{base_url}/{{variable}}_{{mip_table}}_{source_id}_{{experiment}}_{{ensemble_member}}_{{grid}}_{{time_period}}.nc"
+                    }
+                    # one configuration group per MIP table, as in config.yaml
+                    for table in sorted({parts[1] for parts in names}):
+                        group = {
+                            'name': table, 'variables': [BENCHMARK_VARIABLE], 'mip_tables': [table],
+                            'time_periods': [parts[6] for parts in names if parts[1] == table]
+                        }
+                        files, failed_variables = plan_search_files(dataset, group, search_url, page_size=SEARCH_PAGE_SIZE)
+                        urls = [f['url'] for f in files]
+                        checksums = {f['url']: (f['checksum'], f['checksum_type']) for f in files}
+                        if failed_variables:
+                            urls += list(build_candidate_urls(dataset, dict(group, variables=failed_variables)))
+                        downloaded += sum(1 for _, path in download_files(urls, target_dir, checksums=checksums, skip_existing=False) if path)
+            finally:
+                search_server.shutdown()
+            results[f"search/{run}"] = {
+                'files': downloaded,
+                'expected': len(fixtures),
+                'pages': search_server.RequestHandlerClass.pages_served,
+                'seconds': round(time.perf_counter() - started, 3)
+            }
+            logging.info(f"search/{run}: {downloaded}/{len(fixtures)} files, {results[f'search/{run}']['pages']} result pages")
+            if downloaded != len(fixtures):
+                raise RuntimeError(f"Search scenario '{run}' found {downloaded} of {len(fixtures)} fixtures")
+    finally:
+        file_server.shutdown()
+    return results
+
+
+def compare_results(previous, current):
+    """Logs the relative change of time and peak RSS per benchmark between two result files"""
+    for key in sorted(set(previous['results']) & set(current['results'])):
+        old, new = previous['results'][key], current['results'][key]
+        time_change = (new['seconds'] / old['seconds'] - 1) * 100 if old['seconds'] else 0.0
+        line = f"{key:<24} {old['seconds']:>8.2f} s -> {new['seconds']:>8.2f} s ({time_change:+6.1f}%)"
+        if old.get('peak_rss_mb') and new.get('peak_rss_mb'):
+            rss_change = (new['peak_rss_mb'] / old['peak_rss_mb'] - 1) * 100
+            line += f"   RSS {old['peak_rss_mb']:>7.0f} -> {new['peak_rss_mb']:>7.0f} MB ({rss_change:+6.1f}%)"
+        logging.info(line)
+
+
+def main():
+    """Offline benchmark of the download, processing and validation stages"""
+    parser = argparse.ArgumentParser(description="GFDL Data Pipeline: offline benchmarks on synthetic data.")
+    parser.add_argument('--grid', action='append', choices=sorted(GRIDS), help='Grid to benchmark; can be used multiple times (default: all).')
+    parser.add_argument('--frequency', action='append', choices=list(FREQUENCIES), help='Frequency to benchmark; can be used multiple times (default: all).')
+    parser.add_argument('--steps-scale', type=float, default=1.0, help='Multiplies the time steps per fixture file (default: 1.0).')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per stage; the fastest is reported (default: 1).')
+    parser.add_argument('--fixtures-dir', default=os.path.join(tempfile.gettempdir(), 'gfdl_benchmark', 'fixtures'),
+                        help='Where the synthetic files are generated and kept between runs.')
+    parser.add_argument('--out', help="Results JSON (default: 'benchmark_<commit>.json').")
+    parser.add_argument('--compare', help='Earlier results JSON to compare against.')
+    parser.add_argument('--search', action='store_true',
+                        help='Run the search scenario (paged search stand-in, then url_template fallback) instead of the stage benchmarks.')
+    parser.add_argument('--faults', action='store_true',
+                        help='Run the download fault scenario (healthy, flaky and dead hosts) instead of the stage benchmarks.')
+    args = parser.parse_args()
+
+    with open("config.yaml", 'r') as f:
+        config = yaml.safe_load(f)
+
+    grids = args.grid or list(GRIDS)
+    frequencies = args.frequency or list(FREQUENCIES)
+    fixtures = ensure_fixtures(args.fixtures_dir, grids, frequencies, args.steps_scale)
+
+    work_dir = tempfile.mkdtemp(prefix='gfdl_benchmark_')
+    try:
+        if args.search:
+            results = run_search_scenario(fixtures, work_dir)
+        elif args.faults:
+            results = run_fault_scenario(config, fixtures, work_dir)
+        else:
+            results = run_benchmarks(config, fixtures, work_dir, args.repeat)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    commit = _git_commit()
+    report = {
+        'commit': commit,
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'host': {'python': sys.version.split()[0], 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'parameters': {'grids': grids, 'frequencies': frequencies, 'steps_scale': args.steps_scale, 'repeat': args.repeat, 'faults': args.faults, 'search': args.search},
+        'results': results
+    }
+    out_path = args.out or f"benchmark_{commit or 'results'}.json"
+    with open(out_path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    logging.info(f"Benchmark results written to: {out_path}")
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare_results(json.load(f), report)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
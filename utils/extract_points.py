@@ -0,0 +1,47 @@
+import os
+import csv
+import yaml
+import logging
+import argparse
+from modules.catalog import catalog_index_path
+from modules.points import extract_points, PointIndexCache
+
+
+def read_points(points_path):
+    """Reads a CSV with 'name', 'lat' and 'lon' columns into (name, lat, lon) tuples"""
+    with open(points_path, 'r', newline='') as f:
+        return [(row['name'], float(row['lat']), float(row['lon'])) for row in csv.DictReader(f)]
+
+
+def main():
+    """Extracts point time series (e.g. Sao Paulo) from the processed mirror into a table"""
+    parser = argparse.ArgumentParser(description="GFDL Data Pipeline: extract time series at lat/lon points.")
+    parser.add_argument('--points', required=True, help="CSV file with 'name,lat,lon' columns.")
+    parser.add_argument('--region', required=True)
+    parser.add_argument('--model', required=True)
+    parser.add_argument('--experiment', required=True)
+    parser.add_argument('--variable', required=True)
+    parser.add_argument('--frequency', help="e.g. 'day' or 'mon'.")
+    parser.add_argument('--product', choices=['day', 'mon', 'clim'], help='Temporal aggregate to read instead of the native files.')
+    parser.add_argument('--member', action='append', help='Ensemble member; can be used multiple times (default: all).')
+    parser.add_argument('--start', help="Start of the time window, e.g. '1990' or '1990-06-01'.")
+    parser.add_argument('--end', help="End of the time window, e.g. '2014-12-31'.")
+    parser.add_argument('--out', required=True, help='Output CSV path.')
+    args = parser.parse_args()
+
+    with open("config.yaml", 'r') as f:
+        config = yaml.safe_load(f)
+    base_path = config['base_data_path']
+    index_path = catalog_index_path(os.path.join(base_path, config.get('catalog_file', 'metadata/catalog.jsonl')))
+    point_cache = PointIndexCache(os.path.join(base_path, config.get('point_index_cache', 'point_index_cache.json')))
+
+    table = extract_points(
+        index_path, read_points(args.points), args.region, args.model, args.experiment, args.variable,
+        args.frequency, args.member, args.start, args.end, point_cache, product=args.product
+    )
+    table.to_csv(args.out, index=False)
+    logging.info(f"Wrote {len(table)} rows for {table['point'].nunique()} points to: {args.out}")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -1,89 +1,103 @@
 import os
-import xarray as xr
+import yaml
 import logging
+import argparse
+from modules.catalog import build_catalog, DEFAULT_CATALOG_WORKERS
 
 # --- configuration ---
-OUTPUT_FILENAME = "/mnt/datalake/abdullah/gfdl_mirror/metadata/METADATA.md"
-BASE_PROCESSED_PATH = "/mnt/datalake/abdullah/gfdl_mirror"
-REGION_TO_INSPECT = "Southern_Africa"
+OUTPUT_FILENAME = "metadata/METADATA.md"      # relative to base_data_path
+CATALOG_FILENAME = "metadata/catalog.jsonl"   # relative to base_data_path
 
-def main():
+# global attributes copied into the Markdown as file provenance
+PROVENANCE_KEYS = ['source_id', 'history', 'tracking_id', 'variant_label', 'table_id', 'experiment_id', 'frequency']
+
+
+def catalog_markdown(records, base_path):
     """
-    Generates a METADATA.md file by walking through the processed data directories,
-    finding all unique variables in each directory, and inspecting one example
-    file for each unique variable.
+    Renders the METADATA.md variable dictionary from catalog records: one section
+    per directory (relative to its region, shared by all regions) and, within it,
+    one entry per variable with its attributes, provenance and coverage.
     """
     markdown_content = []
     markdown_content.append("# GFDL Mirrored Dataset: Metadata and Variable Dictionary\n\n")
-    markdown_content.append("This document provides a detailed summary of each unique variable present in the processed dataset. The metadata is extracted directly from an example NetCDF file for each variable.\n\n")
-
-    logging.info("--- Metadata Generation Started (v3 - Variable-Aware Scan) ---")
-
-    start_path = os.path.join(BASE_PROCESSED_PATH, REGION_TO_INSPECT)
-    
-    if not os.path.isdir(start_path):
-        logging.error(f"Inspection directory not found: {start_path}")
-        return
-
-    # using os.walk to traverse the directory tree
-    for root, dirs, files in os.walk(start_path):
-        # filter for only .nc files
-        nc_files = [f for f in files if f.endswith('.nc')]
-        
-        if not nc_files:
+    markdown_content.append("This document provides a detailed summary of each unique variable present in the processed dataset. It is generated from the metadata catalog, which records the header of every processed NetCDF file.\n\n")
+
+    # group by directory below the region, then by variable
+    groups = {}
+    for record in records.values():
+        if 'error' in record or 'variable' not in record:
             continue
+        relative_dir = os.path.dirname(os.path.relpath(record['path'], os.path.join(base_path, record['region'])))
+        groups.setdefault(relative_dir, {}).setdefault(record['variable'], []).append(record)
 
-        # 1. find all unique variable IDs in the current directory based on filenames
-        unique_variables_in_dir = sorted(list({f.split('_')[0] for f in nc_files}))
-        
-        # create a main header for the directory path
-        relative_path = os.path.relpath(root, start_path)
-        markdown_content.append(f"### Path: `/{relative_path}`\n\n")
-        
-        # 2. loop through each unique variable found in this directory
-        for variable_id in unique_variables_in_dir:
-            
-            # finding the first file that matches this variable to use as an example
-            example_file = next((f for f in nc_files if f.startswith(variable_id + '_')), None)
-            if not example_file:
+    for relative_dir in sorted(groups):
+        markdown_content.append(f"### Path: `/{relative_dir}`\n\n")
+
+        for variable_id, variable_records in sorted(groups[relative_dir].items()):
+            example = variable_records[0]
+            markdown_content.append(f"#### Variable: `{variable_id}`\n\n")
+
+            if variable_id not in example['variables']:
+                markdown_content.append(f"- **Error:** Variable ID '{variable_id}' not found in the data variables of this file. Skipping.\n\n---\n")
+                logging.warning(f"Variable '{variable_id}' not found in file {example['path']}. Filename might not match content.")
                 continue
 
-            file_path_to_check = os.path.join(root, example_file)
-            logging.info(f"Inspecting '{variable_id}' using file: {example_file}")
-
-            try:
-                with xr.open_dataset(file_path_to_check) as ds:
-                    # --- extract and format Metadata for this specific variable ---
-                    markdown_content.append(f"#### Variable: `{variable_id}`\n\n")
-                    
-                    if variable_id not in ds.data_vars:
-                         markdown_content.append(f"- **Error:** Variable ID '{variable_id}' not found in the data variables of this file. Skipping.\n\n---\n")
-                         logging.warning(f"Variable '{variable_id}' not found in file {example_file}. Filename might not match content.")
-                         continue
-
-                    var_meta = ds[variable_id].attrs
-                    markdown_content.append(f"- **Long Name:** {var_meta.get('long_name', 'N/A')}\n")
-                    markdown_content.append(f"- **Units:** {var_meta.get('units', 'N/A')}\n")
-                    markdown_content.append(f"- **Standard Name:** `{var_meta.get('standard_name', 'N/A')}`\n")
-                    
-                    markdown_content.append("\n**File Provenance (from Global Attributes):**\n")
-                    for key, value in ds.attrs.items():
-                        if key in ['source_id', 'history', 'tracking_id', 'variant_label', 'table_id', 'experiment_id', 'frequency']:
-                            markdown_content.append(f"- **{key}:** {value}\n")
-                    
-                    markdown_content.append("\n---\n")
-
-            except Exception as e:
-                logging.error(f"Could not read metadata from {example_file}. Reason: {e}")
+            var_meta = example['variables'][variable_id]['attrs']
+            markdown_content.append(f"- **Long Name:** {var_meta.get('long_name', 'N/A')}\n")
+            markdown_content.append(f"- **Units:** {var_meta.get('units', 'N/A')}\n")
+            markdown_content.append(f"- **Standard Name:** `{var_meta.get('standard_name', 'N/A')}`\n")
+
+            # coverage across every file of this variable, not just the example
+            starts = [r['time_start'] for r in variable_records if r.get('time_start')]
+            ends = [r['time_end'] for r in variable_records if r.get('time_end')]
+            regions = sorted({r['region'] for r in variable_records})
+            members = sorted({r['member'] for r in variable_records if r.get('member')})
+            markdown_content.append(f"- **Files:** {len(variable_records)} ({sum(r['size'] for r in variable_records) / 1024**2:.1f} MB)\n")
+            if starts and ends:
+                markdown_content.append(f"- **Time Range:** {min(starts)[:10]} to {max(ends)[:10]}\n")
+            markdown_content.append(f"- **Regions:** {', '.join(regions)}\n")
+            if members:
+                markdown_content.append(f"- **Members:** {', '.join(members)}\n")
+
+            markdown_content.append("\n**File Provenance (from Global Attributes):**\n")
+            for key, value in example['global_attrs'].items():
+                if key in PROVENANCE_KEYS:
+                    markdown_content.append(f"- **{key}:** {value}\n")
+
+            markdown_content.append("\n---\n")
+    return markdown_content
+
+
+def main():
+    """
+    Updates the metadata catalog of the processed mirror (header-only scan of every
+    region, incremental) and generates METADATA.md from it.
+    """
+    parser = argparse.ArgumentParser(description="GFDL Data Pipeline: build the metadata catalog and METADATA.md.")
+    parser.add_argument('--rescan', action='store_true', help='Read every header again instead of only new or changed files.')
+    parser.add_argument('--workers', type=int, default=DEFAULT_CATALOG_WORKERS, help='Number of header reading processes.')
+    args = parser.parse_args()
+
+    with open("config.yaml", 'r') as f:
+        config = yaml.safe_load(f)
+    base_path = config['base_data_path']
+    region_names = [region['name'] for region in config.get('processing_regions', [])]
+
+    logging.info("--- Metadata Generation Started (catalog scan) ---")
+    records = build_catalog(
+        base_path, region_names, os.path.join(base_path, config.get('catalog_file', CATALOG_FILENAME)),
+        args.workers, args.rescan
+    )
 
     # --- write the final Markdown file ---
-    output_path = os.path.join(os.getcwd(), OUTPUT_FILENAME)
+    output_path = os.path.join(base_path, OUTPUT_FILENAME)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
     with open(output_path, 'w') as f:
-        f.writelines(markdown_content)
+        f.writelines(catalog_markdown(records, base_path))
 
     logging.info(f"--- Metadata Generation Finished. File saved to: {output_path} ---")
-    print(f"\nSUCCESS: Metadata documentation has been generated and saved to '{OUTPUT_FILENAME}'")
+    print(f"\nSUCCESS: Metadata documentation has been generated and saved to '{output_path}'")
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-    main()
\ No newline at end of file
+    main()
@@ -1,23 +1,208 @@
 import os
+import csv
+import json
+import time
 import yaml
 import logging
-from modules.utils import setup_logging
-from modules.validator import (
-    validate_netcdf_format,
-    validate_time_coverage,
-    validate_data_range,
-    validate_processing_consistency
-)
-
-def get_variable_category(variable, categories_map):
-    """Finds the category for a given variable from the config map"""
-    for category, variables in categories_map.items():
-        if variable in variables:
-            return category
-    return "uncategorized"
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from main import build_candidate_urls, build_processed_dir, get_variable_category
+from modules.utils import setup_logging, ensure_dir_exists
+from modules.manifest import Manifest
+from modules.grid_index import GridIndexCache
+from modules.downloader import read_checksum_sidecar
+from modules.validation_cache import ValidationCache, file_identity, rules_signature
+from modules.validator import validate_file, DEFAULT_RANGE_MEMORY_MB, DEFAULT_HISTOGRAM_BINS
+from modules.metrics import metrics_recorder, DEFAULT_SUMMARY_TOP
+
+# default number of validation worker processes (overridable from config.yaml 'validation_settings')
+DEFAULT_VALIDATION_WORKERS = 4
+
+# threads used to stat files when comparing them with the validation cache
+STAT_WORKERS = 32
+
+# columns of the CSV report, one row per raw or processed file
+CSV_COLUMNS = ['file', 'kind', 'dataset', 'region', 'variable', 'passed', 'cached', 'seconds', 'failed_checks', 'messages']
+
+
+def period_years(period):
+    """Start and end year of a CMIP6 time_period string, e.g. '185001-194912' -> (1850, 1949)"""
+    start, end = period.split('-')
+    return int(start[:4]), int(end[:4])
+
+
+def build_validation_jobs(config, datasets, manifest=None):
+    """
+    Expands the configuration_groups of every dataset and the processing_regions
+    into one job per raw file found locally, together with its processed files.
+    Existence comes from the state manifest when one is available, otherwise
+    from the filesystem.
+    """
+    base_path = config['base_data_path']
+    raw_dir = os.path.join(base_path, config['raw_data_dir'])
+    processing_regions = config.get('processing_regions', [])
+    variable_ranges = config.get('validation_rules', {}).get('variable_ranges', {})
+
+    if manifest is not None:
+        done_raw_files = manifest.done_raw_files()
+        done_outputs = manifest.done_outputs(config.get('output_backend', 'netcdf'))
+        raw_exists = lambda path: done_raw_files.get(os.path.basename(path)) == path
+        output_exists = lambda path: path in done_outputs
+    else:
+        raw_exists = output_exists = os.path.exists
+
+    jobs = {}
+    for dataset in datasets:
+        for group in dataset.get('configuration_groups', []):
+            for url, variable in build_candidate_urls(dataset, group).items():
+                file_name = url.split('/')[-1]
+                raw_file_path = os.path.join(raw_dir, file_name)
+                # candidate versions share a file name, so each file is validated once
+                if raw_file_path in jobs or not raw_exists(raw_file_path):
+                    continue
+
+                category = get_variable_category(variable, config['variable_categories'])
+                processed_files = []
+                for region in processing_regions:
+                    processed_file_path = os.path.join(
+                        build_processed_dir(base_path, region['name'], dataset, category), file_name
+                    )
+                    if output_exists(processed_file_path):
+                        processed_files.append((processed_file_path, region['bounding_box'], region['name']))
+                    else:
+                        logging.warning(f"  [WARN] Processed file is missing for existing raw file: {processed_file_path}")
+
+                expected_start, expected_end = period_years(file_name[:-len('.nc')].rsplit('_', 1)[1])
+                jobs[raw_file_path] = {
+                    'dataset': dataset['name'],
+                    'group': group['name'],
+                    'variable': variable,
+                    'raw_file_path': raw_file_path,
+                    'expected_start': expected_start,
+                    'expected_end': expected_end,
+                    'valid_range': variable_ranges.get(variable, variable_ranges.get('default')),
+                    'processed_files': processed_files
+                }
+    return list(jobs.values())
+
+
+def run_validation_job(job, range_check, index_cache=None):
+    """
+    Worker: validates one raw file and its processed files, returning flat report rows.
+    With job['check_raw'] False only the processed files are checked. 'index_cache'
+    is the pipeline's GridIndexCache, so region slices are not recomputed per file
+    """
+    report = validate_file(
+        job['raw_file_path'], job['variable'], job['expected_start'], job['expected_end'], job['valid_range'],
+        [(path, geo_scope) for path, geo_scope, _ in job['processed_files']], index_cache,
+        memory_budget_mb=range_check.get('memory_budget_mb', DEFAULT_RANGE_MEMORY_MB),
+        histogram_bins=range_check.get('histogram_bins', DEFAULT_HISTOGRAM_BINS),
+        check_raw=job.get('check_raw', True)
+    )
+    regions = {path: region_name for path, _, region_name in job['processed_files']}
+    summaries = [('raw', None, report['raw'])] if report['raw'] else []
+    summaries += [('processed', regions.get(summary['file']), summary) for summary in report['processed']]
+    return [
+        {
+            'file': summary['file'],
+            'kind': kind,
+            'dataset': job['dataset'],
+            'region': region_name,
+            'variable': job['variable'],
+            'passed': summary['passed'],
+            'cached': False,
+            'seconds': summary['seconds'],
+            'checks': summary['checks']
+        }
+        for kind, region_name, summary in summaries
+    ]
+
+
+def plan_cached_jobs(jobs, cached, validation_rules, raw_checksums):
+    """
+    Compares every file of the jobs with the validation cache. Returns the rows
+    that can be reused, the jobs (reduced to their changed files) that still have
+    to run, and the cache key (identity, rules_signature) of every file.
+
+    A raw file is reused while its size, mtime and checksum and the rules of its
+    variable are unchanged; a processed file additionally requires its raw file
+    to be unchanged, since it is checked against it.
+    """
+    paths = [job['raw_file_path'] for job in jobs]
+    paths += [path for job in jobs for path, _, _ in job['processed_files']]
+
+    def _identity(path):
+        checksum = raw_checksums.get(path)
+        if checksum is None and path in raw_paths:
+            checksum = (read_checksum_sidecar(path) or (None, None))[1]
+        return file_identity(path, checksum)
+
+    # stat calls are latency bound on the datalake, so they are overlapped
+    raw_paths = set(paths[:len(jobs)])
+    with ThreadPoolExecutor(max_workers=STAT_WORKERS) as executor:
+        identities = dict(zip(paths, executor.map(_identity, paths)))
+
+    reused, pending, keys = [], [], {}
+    for job in jobs:
+        signature = rules_signature(validation_rules, job['variable'])
+        raw_file_path = job['raw_file_path']
+        raw_identity = identities[raw_file_path]
+        keys[raw_file_path] = (raw_identity, signature)
+
+        changed = []
+        for processed_file_path, geo_scope, region_name in job['processed_files']:
+            keys[processed_file_path] = (f"{identities[processed_file_path]}|{raw_identity}", signature)
+            if cached.get(processed_file_path, (None, None))[:2] == keys[processed_file_path]:
+                reused.append(dict(cached[processed_file_path][2], cached=True))
+            else:
+                changed.append((processed_file_path, geo_scope, region_name))
+
+        raw_unchanged = cached.get(raw_file_path, (None, None))[:2] == keys[raw_file_path]
+        if raw_unchanged:
+            reused.append(dict(cached[raw_file_path][2], cached=True))
+        if not raw_unchanged or changed:
+            pending.append(dict(job, processed_files=changed, check_raw=not raw_unchanged))
+    return reused, pending, keys
+
+
+def write_report(rows, report_path, started):
+    """Writes the report as JSON or CSV depending on the file extension, sorted by path so runs diff cleanly"""
+    rows = sorted(rows, key=lambda row: row['file'])
+    ensure_dir_exists(os.path.dirname(report_path) or '.')
+    tmp_path = report_path + '.tmp'
+    if report_path.endswith('.csv'):
+        with open(tmp_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_COLUMNS)
+            writer.writeheader()
+            for row in rows:
+                failed = [c for c in row['checks'] if not c['passed']]
+                writer.writerow({
+                    **{key: row[key] for key in CSV_COLUMNS if key in row},
+                    'failed_checks': ';'.join(c['check'] for c in failed),
+                    'messages': ' | '.join(c['message'] for c in failed)
+                })
+    else:
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'started': started,
+                'finished': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'files_checked': len(rows),
+                'files_failed': sum(1 for row in rows if not row['passed']),
+                'files': rows
+            }, f, indent=1)
+    os.replace(tmp_path, report_path)
+
 
 def main():
     """Standalone script to validate the existing GFDL dataset"""
+    parser = argparse.ArgumentParser(description="GFDL Data Pipeline: validate the raw and processed files.")
+    parser.add_argument('--name', action='append', help='Only validate this dataset from config.yaml. Can be used multiple times.')
+    parser.add_argument('--workers', type=int, help='Number of validation worker processes.')
+    parser.add_argument('--report', help='Report path; a .csv extension writes CSV, anything else JSON.')
+    parser.add_argument('--force', action='store_true', help='Re-validate every file, ignoring cached results.')
+    args = parser.parse_args()
+
     with open("config.yaml", 'r') as f:
         config = yaml.safe_load(f)
 
@@ -26,67 +211,92 @@ def main():
     log_path = os.path.join(base_path, "validation.log")
     setup_logging(log_path)
     logging.info("--- Dataset Validation Started ---")
+    started = time.strftime('%Y-%m-%dT%H:%M:%S')
 
     # --- load configuration for validation ---
-    geo_scope = config['geographical_scope']
-    validation_rules = config.get('validation_rules', {})
-    raw_dir_name = config['raw_data_dir']
-
-    # --- iterate through expected files ---
-    for dataset in config['datasets']:
-        logging.info(f"\n===== Validating Dataset: {dataset['name']} =====")
-        
-        for variable in dataset.get('variables_to_download', []):
-            for mip_table in dataset['mip_tables_to_try']:
-                for grid in dataset['grids_to_try']:
-                    for member in dataset['ensemble_members']:
-                        # iterate through the list of time period objects
-                        for period_info in dataset['time_periods']:
-                            
-                            # extract the explicit values from the config
-                            period_string = period_info['period_string']
-                            expected_start = period_info['start_year']
-                            expected_end = period_info['end_year']
-
-                            # reconstruct the filename using the period_string
-                            file_name = dataset['url_template'].format(
-                                experiment=dataset['experiment'],
-                                ensemble_member=member,
-                                mip_table=mip_table,
-                                variable=variable,
-                                grid=grid,
-                                time_period=period_string # using string for the filename
-                            ).split('/')[-1]
-
-                            category = get_variable_category(variable, config['variable_categories'])
-                            raw_file_path = os.path.join(base_path, raw_dir_name, file_name)
-                            processed_file_path = os.path.join(base_path, dataset['model'], dataset['experiment'], category, file_name)
-
-                            if not os.path.exists(raw_file_path):
-                                continue
-                            
-                            logging.info(f"--- Checking: {file_name} ---")
-
-                            # 1. Validate raw file
-                            logging.info("-> Validating Raw File...")
-                            if validate_netcdf_format(raw_file_path):
-                                # pass the explicit years to the validation function
-                                validate_time_coverage(raw_file_path, expected_start, expected_end)
-                                
-                                var_range = validation_rules.get('variable_ranges', {}).get(variable, validation_rules.get('variable_ranges', {}).get('default'))
-                                if var_range:
-                                    validate_data_range(raw_file_path, variable, var_range['min'], var_range['max'])
-
-                            # 2. Validate processed file
-                            if not os.path.exists(processed_file_path):
-                                logging.warning(f"  [WARN] Processed file is missing for existing raw file: {file_name}")
-                                continue
-                            
-                            logging.info("-> Validating Processed File...")
-                            if validate_netcdf_format(processed_file_path):
-                                validate_processing_consistency(raw_file_path, processed_file_path, geo_scope, variable)
+    validation_settings = config.get('validation_settings', {})
+    range_check = config.get('validation_rules', {}).get('range_check', {})
+    workers = args.workers or validation_settings.get('workers', DEFAULT_VALIDATION_WORKERS)
+    report_path = args.report or os.path.join(
+        base_path, validation_settings.get('report_dir', 'validation_reports'),
+        f"validation_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    )
+
+    datasets = config.get('datasets', [])
+    if args.name:
+        datasets = [dataset for dataset in datasets if dataset['name'] in args.name]
+
+    # --- expand the expected files ---
+    manifest_path = os.path.join(base_path, os.path.expanduser(config.get('manifest_file', 'manifest.sqlite')))
+    manifest = Manifest(manifest_path) if os.path.exists(manifest_path) else None
+    jobs = build_validation_jobs(config, datasets, manifest)
+    raw_checksums = manifest.raw_checksums() if manifest is not None else {}
+    if manifest is not None:
+        manifest.close()
+
+    # --- reuse the results of unchanged files ---
+    cache = ValidationCache(os.path.join(
+        base_path, os.path.expanduser(validation_settings.get('cache_file', 'validation_cache.sqlite'))
+    ))
+    cached = {} if args.force else cache.load()
+    rows, jobs, cache_keys = plan_cached_jobs(jobs, cached, config.get('validation_rules', {}), raw_checksums)
+    logging.info(f"Reusing {len(rows)} cached results; validating {sum(job['check_raw'] for job in jobs)} raw files and {sum(len(job['processed_files']) for job in jobs)} processed files with {workers} workers.")
+
+    # --- validate across a process pool ---
+    # the same persisted region index ranges the processing stage uses
+    index_cache = GridIndexCache(
+        os.path.join(base_path, config.get('grid_index_cache', 'grid_index_cache.json')), config.get('processing_regions', [])
+    )
+    metrics = metrics_recorder(config, base_path, 'validation')
+    new_results = []
+    with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=setup_logging,
+            initargs=(log_path,)
+    ) as executor:
+        futures = {executor.submit(run_validation_job, job, range_check, index_cache): job for job in jobs}
+        remaining = len(futures)
+        for future in as_completed(futures):
+            job = futures[future]
+            remaining -= 1
+            queue_depth = remaining
+            try:
+                job_rows = future.result()
+                rows.extend(job_rows)
+                for row in job_rows:
+                    metrics.record(
+                        'validate', row['seconds'] or 0.0,
+                        bytes_in=os.path.getsize(row['file']) if os.path.isfile(row['file']) else 0,
+                        status='done' if row['passed'] else 'failed', queue_depth=queue_depth,
+                        dataset=job['dataset'], group=job['group'], variable=job['variable'],
+                        file=os.path.basename(row['file']), kind=row['kind'], region=row['region']
+                    )
+                # results with a check that could not be determined (e.g. a read error) are
+                # not cached, so they are retried next time instead of reused as failures
+                new_results.extend(
+                    (row['file'],) + cache_keys[row['file']] + (row,) for row in job_rows
+                    if not any(c['passed'] is None for c in row['checks'])
+                )
+            except Exception as e:
+                logging.error(f"  [FAIL] Validation worker failed for {job['raw_file_path']}. Error: {e}")
+                metrics.record('validate', 0.0, status='failed', queue_depth=queue_depth, dataset=job['dataset'],
+                               group=job['group'], variable=job['variable'], file=os.path.basename(job['raw_file_path']))
+                rows.append({
+                    'file': job['raw_file_path'], 'kind': 'raw', 'dataset': job['dataset'], 'region': None,
+                    'variable': job['variable'], 'passed': None, 'cached': False, 'seconds': None,
+                    'checks': [{'check': 'worker', 'passed': None, 'message': str(e), 'details': {}}]
+                })
+
+    cache.store(new_results)
+    cache.close()
 
+    write_report(rows, report_path, started)
+    failed = sum(1 for row in rows if not row['passed'])
+    logging.info(f"{len(rows)} files checked, {failed} failed. Report written to: {report_path}")
+    metrics.summary(config.get('metrics_settings', {}).get('summary_top', DEFAULT_SUMMARY_TOP))
+    metrics.close()
     logging.info("\n--- Dataset Validation Finished ---")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()